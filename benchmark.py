@@ -0,0 +1,196 @@
+import json
+import logging
+import platform
+import sys
+import time
+
+import click
+import numpy as np
+
+import calculations
+import constants
+import model
+import run
+
+NUMBERS_OF_PARTICLES = [1e1, 1e2, 1e3, 1e4]
+SEED = 2020
+
+
+@click.command()
+@click.option("--engine", "engines", multiple=True, type=click.Choice(list(model.ENGINES)))
+@click.option("--particles", "numbers_of_particles", multiple=True, type=float)
+@click.option("--steps", type=int, default=10 ** 5)
+@click.option("--repeat", type=int, default=3)
+@click.option("--convergence", is_flag=True, default=False)
+@click.option("--convergence-max-particles", type=float, default=1e2)
+@click.option("--save-baseline", type=click.Path(), default=None)
+@click.option("--baseline", type=click.Path(exists=True), default=None)
+@click.option("--threshold", type=float, default=0.2)
+def main(
+    engines,
+    numbers_of_particles,
+    steps,
+    repeat,
+    convergence,
+    convergence_max_particles,
+    save_baseline,
+    baseline,
+    threshold,
+):
+    # Every case is run with fixed seeds and the best of repeat timings is kept, so
+    # two runs on the same machine are comparable. A run compared against a
+    # baseline exits with status 1 if any case got slower by more than threshold.
+    logging.getLogger().setLevel(logging.WARNING)
+    engines = engines or list(model.ENGINES)
+    numbers_of_particles = numbers_of_particles or NUMBERS_OF_PARTICLES
+
+    results = {}
+    for number_of_particles in numbers_of_particles:
+        for label, temperature in get_temperatures(number_of_particles).items():
+            case = f"{int(number_of_particles)}/{label}"
+            results[f"find_mu/{case}"] = benchmark_find_mu(
+                number_of_particles, temperature, repeat
+            )
+            results[f"get_decrease_probability_table/{case}"] = (
+                benchmark_get_decrease_probability_table(
+                    number_of_particles, temperature, repeat
+                )
+            )
+            for engine in engines:
+                results[f"run_steps/{engine}/{case}"] = benchmark_run_steps(
+                    number_of_particles, temperature, engine, steps, repeat
+                )
+                if convergence and number_of_particles <= convergence_max_particles:
+                    results[f"convergence/{engine}/{case}"] = benchmark_convergence(
+                        number_of_particles, temperature, engine
+                    )
+            for name in [name for name in results if name.endswith(f"/{case}")]:
+                _print_result(name, results[name])
+
+    if save_baseline is not None:
+        with open(save_baseline, "wt") as file:
+            json.dump(
+                {"environment": get_environment(), "results": results}, file, indent=4
+            )
+
+    if baseline is not None:
+        with open(baseline, "rt") as file:
+            baseline_data = json.load(file)
+        regressions = compare(baseline_data["results"], results, threshold)
+        if baseline_data["environment"] != get_environment():
+            print(
+                f"Warning: the baseline was recorded on {baseline_data['environment']}"
+            )
+        for name, baseline_result, result in regressions:
+            print(
+                f"Regression: {name}: {result['value']:.4g} {result['unit']} "
+                f"(baseline: {baseline_result['value']:.4g} {baseline_result['unit']})"
+            )
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {threshold:.0%}")
+
+
+def get_temperatures(number_of_particles):
+    # The condensation temperature of the ideal gas in a 3D harmonic trap,
+    # (N / zeta(3)) ** (1 / 3), separates the low and high temperature regimes
+    critical_temperature = (number_of_particles / 1.2020569) ** (1 / 3)
+    return {
+        "low": 0.2,
+        "critical": round(critical_temperature, 1),
+        "high": round(2 * critical_temperature, 1),
+    }
+
+
+def benchmark_find_mu(number_of_particles, temperature, repeat):
+    def find_mu():
+        for _ in range(100):
+            calculations.clear_caches()
+            calculations.find_mu(temperature, number_of_particles)
+
+    return _get_rate(find_mu, 100, repeat, unit="calls/s")
+
+
+def benchmark_get_decrease_probability_table(number_of_particles, temperature, repeat):
+    mu = calculations.find_mu(temperature, number_of_particles)
+
+    def get_decrease_probability_tables():
+        for _ in range(100):
+            calculations.clear_caches()
+            calculations.get_decrease_probability_table(mu, temperature)
+
+    return _get_rate(get_decrease_probability_tables, 100, repeat, unit="calls/s")
+
+
+def benchmark_run_steps(number_of_particles, temperature, engine, steps, repeat):
+    current_run = model.ENGINES[engine](
+        temperature=temperature,
+        max_energy_level=constants.MAX_ENERGY_LEVEL,
+        number_of_particles=number_of_particles,
+        mu=calculations.find_mu(temperature, number_of_particles),
+        rng=np.random.default_rng(
+            model.get_seed_sequence(SEED, number_of_particles, temperature)
+        ),
+    )
+    # Leave the initial condition before timing the stationary chain
+    current_run.run_steps(int(number_of_particles * 10))
+    return _get_rate(lambda: current_run.run_steps(steps), steps, repeat, unit="steps/s")
+
+
+def benchmark_convergence(number_of_particles, temperature, engine):
+    current_model = model.Model(
+        number_of_particles=number_of_particles,
+        temperature=temperature,
+        stop_condition=run._get_stop_condition(temperature),
+        engine=engine,
+        seed=SEED,
+    )
+    start_time = time.perf_counter()
+    result = current_model.run()
+    return {
+        "value": time.perf_counter() - start_time,
+        "unit": "s",
+        "higher_is_better": False,
+        "steps": result.data.steps,
+    }
+
+
+def compare(baseline_results, results, threshold):
+    regressions = []
+    for name, result in results.items():
+        baseline_result = baseline_results.get(name)
+        if baseline_result is None:
+            continue
+        if result["higher_is_better"]:
+            regressed = result["value"] < baseline_result["value"] * (1 - threshold)
+        else:
+            regressed = result["value"] > baseline_result["value"] * (1 + threshold)
+        if regressed:
+            regressions.append((name, baseline_result, result))
+    return regressions
+
+
+def get_environment():
+    return {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+
+
+def _get_rate(function, calls, repeat, unit):
+    best_time = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return {"value": calls / best_time, "unit": unit, "higher_is_better": True}
+
+
+def _print_result(name, result):
+    print(f"{name}: {result['value']:.4g} {result['unit']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
+import json
+import pathlib
+
 import numpy as np
 from constants import *
 
+_mu_cache = {}
+_probability_table_cache = {}
+
 
 def g(energy_level):
     # Calculates the degeneracy in the system
@@ -9,30 +15,98 @@ def g(energy_level):
 
 
 def get_number_of_particles(mu, temperature):
-    T = temperature
-    beta = 1 / T
-    return sum(
-        [g(n) / (np.exp(beta * (n - mu)) - 1) for n in range(MAX_ENERGY_LEVEL + 1)]
-    )
+    number_of_particles, _ = get_numbers_of_particles([mu], [temperature])
+    return float(number_of_particles[0])
+
+
+def get_numbers_of_particles(mus, temperatures, max_energy_level=MAX_ENERGY_LEVEL):
+    # Vectorized over temperatures, returns the particle numbers and their
+    # derivatives with respect to mu
+    n = np.arange(max_energy_level + 1)
+    beta = np.divide(1, np.asarray(temperatures, dtype=np.float64))[:, None]
+    mus = np.asarray(mus, dtype=np.float64)[:, None]
+    exponent = beta * (n - mus)
+    occupations = g(n) / np.expm1(exponent)
+    derivatives = beta * occupations * (occupations / g(n) + 1)
+    return occupations.sum(axis=1), derivatives.sum(axis=1)
 
 
 def find_mu(temperature, number_of_particles):
-    T, N = temperature, number_of_particles
-    mu_min = MU_MIN
-    mu_max = 0
+    return float(find_mus([temperature], number_of_particles)[0])
+
+
+def find_mus(
+    temperatures,
+    number_of_particles,
+    max_energy_level=MAX_ENERGY_LEVEL,
+    tolerance=MU_TOLERANCE,
+):
+    temperatures = np.asarray(temperatures, dtype=np.float64)
+    keys = [
+        _get_mu_cache_key(number_of_particles, temperature, max_energy_level)
+        for temperature in temperatures
+    ]
+    missing = np.array([key not in _mu_cache for key in keys], dtype=bool)
+    if missing.any():
+        mus = _solve_mus(
+            temperatures[missing], number_of_particles, max_energy_level, tolerance
+        )
+        for key, mu in zip(np.array(keys)[missing], mus):
+            _mu_cache[key] = float(mu)
+    return np.array([_mu_cache[key] for key in keys])
+
+
+def _solve_mus(temperatures, number_of_particles, max_energy_level, tolerance):
+    # Newton's method on log(N(mu) / N), safeguarded by bisection. The ground state
+    # holding every particle gives the upper end of the bracket, since the other
+    # levels can only add particles.
+    T, N = temperatures, number_of_particles
+    mu_max = -T * np.log1p(1 / N)
+    mu_min = np.full_like(T, MU_MIN)
+    while True:
+        N_min, _ = get_numbers_of_particles(mu_min, T, max_energy_level)
+        too_high = N_min > N
+        if not too_high.any():
+            break
+        mu_min[too_high] *= 2
+
+    mu = mu_max.copy()
+    for _ in range(MU_MAX_ITERATIONS):
+        N_try, dN_dmu = get_numbers_of_particles(mu, T, max_energy_level)
+        error = np.log(N_try / N)
+        if np.all(np.abs(error) <= tolerance):
+            break
+
+        mu_min = np.where(error < 0, mu, mu_min)
+        mu_max = np.where(error > 0, mu, mu_max)
+        newton_mu = mu - error * N_try / dN_dmu
+        outside_bracket = (newton_mu <= mu_min) | (newton_mu >= mu_max)
+        mu = np.where(outside_bracket, (mu_min + mu_max) / 2, newton_mu)
 
-    mu_try = (mu_min + mu_max) / 2
-    N_try = get_number_of_particles(mu=mu_try, temperature=T)
+    return mu
 
-    while N != int(N_try):
-        mu_try = (mu_min + mu_max) / 2
-        N_try = get_number_of_particles(mu=mu_try, temperature=T)
-        if N_try > N:
-            mu_max = mu_try
-        else:
-            mu_min = mu_try
 
-    return mu_try
+def _get_mu_cache_key(number_of_particles, temperature, max_energy_level):
+    return f"{float(number_of_particles)!r},{float(temperature)!r},{int(max_energy_level)}"
+
+
+def load_mu_cache(path):
+    path = pathlib.Path(path)
+    if path.exists():
+        with path.open("rt") as file:
+            _mu_cache.update(json.load(file))
+
+
+def save_mu_cache(path):
+    with pathlib.Path(path).open("wt") as file:
+        json.dump(_mu_cache, file, indent=4)
+
+
+def clear_caches():
+    # Forgets every memoized mu and probability table, so that their solvers can
+    # be timed
+    _mu_cache.clear()
+    _probability_table_cache.clear()
 
 
 def get_increase_probability(mu, temperature, energy_level):
@@ -51,6 +125,144 @@ def get_decrease_probability(mu, temperature, energy_level):
     return np.divide(minus_state, plus_state + minus_state)
 
 
+def get_swap_probability(
+    occurrences_a, occurrences_b, log_probabilities_a, log_probabilities_b
+):
+    # Acceptance of exchanging two configurations, given as level occupancies,
+    # between the chains a and b. The stationary weight of a configuration is the
+    # product of the single particle level probabilities of its chain (the
+    # multinomial factor is the same on both sides and cancels).
+    exponent = np.dot(
+        np.subtract(occurrences_b, occurrences_a, dtype=np.float64),
+        np.subtract(log_probabilities_a, log_probabilities_b),
+    )
+    return float(np.exp(min(exponent, 0)))
+
+
+def get_decrease_probability_table(mu, temperature, max_energy_level=MAX_ENERGY_LEVEL):
+    key = (float(mu), float(temperature), int(max_energy_level))
+    if key not in _probability_table_cache:
+        get_decrease_probability_tables([mu], [temperature], max_energy_level)
+    return _probability_table_cache[key]
+
+
+def get_decrease_probability_tables(mus, temperatures, max_energy_level=MAX_ENERGY_LEVEL):
+    # One row of decrease probabilities per (mu, temperature) pair. Every row is
+    # memoized as a read-only array, so runs with the same parameters (and pool
+    # workers forked after the tables were built) share a single copy.
+    keys = [
+        (float(mu), float(temperature), int(max_energy_level))
+        for mu, temperature in zip(mus, temperatures)
+    ]
+    missing = [key for key in keys if key not in _probability_table_cache]
+    if missing:
+        tables = _build_decrease_probability_tables(
+            [mu for mu, _, _ in missing],
+            [temperature for _, temperature, _ in missing],
+            max_energy_level,
+        )
+        tables.flags.writeable = False
+        for key, table in zip(missing, tables):
+            _probability_table_cache[key] = table
+    tables = np.array([_probability_table_cache[key] for key in keys])
+    tables.flags.writeable = False
+    return tables
+
+
+def _build_decrease_probability_tables(mus, temperatures, max_energy_level):
+    n = np.arange(max_energy_level + 1)
+    beta = np.divide(1, np.asarray(temperatures, dtype=np.float64))[:, None]
+    mus = np.asarray(mus, dtype=np.float64)[:, None]
+    lower_n = np.maximum(n - 1, 0)
+    plus_state = g(n + 1) / np.expm1(beta * (n + 1 - mus))
+    minus_state = g(lower_n) / np.expm1(beta * (lower_n - mus))
+    return minus_state / (plus_state + minus_state)
+
+
+def get_stationary_log_probabilities(mu, temperature, max_energy_level=MAX_ENERGY_LEVEL):
+    # Every step moves one particle by its own level only, so the chain samples a
+    # product of independent birth-death chains; detailed balance of one of them
+    # gives the probability of every level
+    decrease_probabilities = get_decrease_probability_table(
+        mu, temperature, max_energy_level
+    )
+    log_probabilities = np.concatenate(
+        [
+            [0],
+            np.cumsum(
+                np.log1p(-decrease_probabilities[:-1])
+                - np.log(decrease_probabilities[1:])
+            ),
+        ]
+    )
+    return log_probabilities - np.logaddexp.reduce(log_probabilities)
+
+
+def get_independent_particle_observables(log_probabilities, number_of_particles):
+    # N independent particles with the given normalized level log probabilities
+    # (one row per case), so the ground state occupancy is binomial and the energy
+    # fluctuation is N times the single particle one
+    probabilities = np.exp(log_probabilities)
+    levels = np.arange(probabilities.shape[-1])
+    ground_state = probabilities[..., 0]
+    energy = (probabilities * levels).sum(axis=-1)
+    energy_variance = (probabilities * np.square(levels)).sum(axis=-1) - np.square(
+        energy
+    )
+    return {
+        "ground_state_expected_value": number_of_particles * ground_state,
+        "ground_state_std": np.sqrt(
+            number_of_particles * ground_state * (1 - ground_state)
+        ),
+        "total_energy_expected_value": number_of_particles * energy,
+        "total_energy_std": np.sqrt(
+            number_of_particles * np.maximum(energy_variance, 0)
+        ),
+    }
+
+
+def get_top_energy_level(
+    mu,
+    temperature,
+    number_of_particles,
+    max_energy_level=MAX_ENERGY_LEVEL,
+    tolerance=LEVEL_TAIL_TOLERANCE,
+):
+    # The lowest level that the stationary chain holds fewer than tolerance
+    # particles on, counting every level above it too. Runs start with the levels
+    # below it active and grow the range when a particle reaches it.
+    log_probabilities = get_stationary_log_probabilities(
+        mu, temperature, max_energy_level
+    )
+    log_tails = np.logaddexp.accumulate(log_probabilities[::-1])[::-1]
+    below_tolerance = np.flatnonzero(
+        np.log(number_of_particles) + log_tails < np.log(tolerance)
+    )
+    if len(below_tolerance) == 0:
+        return max_energy_level
+    return max(int(below_tolerance[0]), 1)
+
+
+def get_heat_capacity_score_table(
+    temperature, number_of_particles, max_energy_level=MAX_ENERGY_LEVEL
+):
+    # Derivative of the log stationary probability of every level with respect to
+    # the temperature, with mu following at fixed N. Summed over the particles it
+    # is the score S of a state, and C = dE/dT = Cov(E, S). For Boltzmann sampling
+    # S = (E - <E>) / T^2, which gives the usual Var(E) / T^2.
+    step = HEAT_CAPACITY_STEP * temperature
+    temperatures = [temperature - step, temperature + step]
+    lower, upper = [
+        get_stationary_log_probabilities(mu, shifted_temperature, max_energy_level)
+        for mu, shifted_temperature in zip(
+            find_mus(temperatures, number_of_particles, max_energy_level), temperatures
+        )
+    ]
+    score_table = (upper - lower) / (2 * step)
+    score_table.flags.writeable = False
+    return score_table
+
+
 def get_specific_heat_capacities(total_energies, temperatures):
     heat_capacities = []
     for i in range(len(total_energies) - 1):
@@ -70,5 +282,35 @@ def get_critical_temperature(
         for expected_value in ground_state_expected_values
     ]
     for index, temperature in enumerate(x):
-        if y[index] < 0.1:
+        if y[index] < CRITICAL_GROUND_STATE_FRACTION:
             return temperature
+
+
+def get_refinement_temperatures(
+    temperatures,
+    ground_state_expected_values,
+    number_of_particles,
+    heat_capacities=None,
+    min_step=ADAPTIVE_MIN_STEP,
+):
+    # Midpoints of the intervals where the curves still change quickly: the ground
+    # state fraction changes by more than ADAPTIVE_FRACTION_CHANGE or crosses the
+    # critical fraction, or the heat capacity changes by more than
+    # ADAPTIVE_HEAT_CAPACITY_CHANGE of its range. Midpoints lie on the min_step
+    # grid, so intervals of min_step are never split.
+    temperatures = np.asarray(temperatures, dtype=np.float64)
+    fractions = np.asarray(ground_state_expected_values) / number_of_particles
+    split = np.abs(np.diff(fractions)) > ADAPTIVE_FRACTION_CHANGE
+    split |= (fractions[:-1] - CRITICAL_GROUND_STATE_FRACTION) * (
+        fractions[1:] - CRITICAL_GROUND_STATE_FRACTION
+    ) <= 0
+    if heat_capacities is not None and None not in heat_capacities:
+        heat_capacities = np.asarray(heat_capacities, dtype=np.float64)
+        split |= np.abs(np.diff(heat_capacities)) > (
+            ADAPTIVE_HEAT_CAPACITY_CHANGE * np.ptp(heat_capacities)
+        )
+    midpoints = np.round((temperatures[:-1] + temperatures[1:]) / 2 / min_step) * min_step
+    split &= (midpoints > temperatures[:-1] + min_step / 2) & (
+        midpoints < temperatures[1:] - min_step / 2
+    )
+    return [round(float(midpoint), 10) for midpoint in midpoints[split]]
@@ -0,0 +1,34 @@
+import os
+import pathlib
+import pickle
+
+VERSION = 7
+
+
+def save(path, state):
+    # Written to a temporary file and renamed, so a crash while saving never
+    # leaves a truncated checkpoint behind. Every run carries its own generator,
+    # so the random state is part of the pickled runs.
+    path = pathlib.Path(path)
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    with temporary_path.open("wb") as file:
+        pickle.dump(
+            {"version": VERSION, **state},
+            file,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.replace(temporary_path, path)
+
+
+def load(path):
+    path = pathlib.Path(path)
+    if not path.exists():
+        return None
+
+    with path.open("rb") as file:
+        state = pickle.load(file)
+    if state["version"] != VERSION:
+        raise ValueError(
+            f"Checkpoint {path} has version {state['version']}, expected {VERSION}"
+        )
+    return state
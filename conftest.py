@@ -0,0 +1,2 @@
+# The modules live at the top level of the repository, next to this file, so
+# pytest puts this directory on sys.path for the tests
@@ -1,3 +1,27 @@
 MAX_ENERGY_LEVEL = 100
+LEVEL_TAIL_TOLERANCE = 1e-3
 MU_MIN = -30
-MAX_STEPS = 1e8
\ No newline at end of file
+MAX_STEPS = 1e8
+BLOCK_SIZE = 2 ** 14
+SWAP_INTERVAL = 1000
+NUMBER_OF_BATCHES = 32
+BATCH_CORRELATION_TIMES = 2
+CHECKPOINT_INTERVAL = 60
+CHECKPOINT_STEPS = 10 ** 6
+MU_TOLERANCE = 1e-12
+MU_MAX_ITERATIONS = 200
+STORE_TIMEOUT = 60
+HEAT_CAPACITY_STEP = 1e-4
+BURN_IN_SWEEPS = 10
+CRITICAL_GROUND_STATE_FRACTION = 0.1
+ADAPTIVE_MIN_STEP = 0.2
+ADAPTIVE_INITIAL_INTERVALS = 8
+ADAPTIVE_FRACTION_CHANGE = 0.05
+ADAPTIVE_HEAT_CAPACITY_CHANGE = 0.1
+REWEIGHTING_POINTS = 200
+EXACT_MAX_PARTICLES = 1e3
+CROSS_CHECK_MAX_DEVIATION = 5
+QUEUE_HEARTBEAT_INTERVAL = 10
+QUEUE_STALE_TIME = 120
+QUEUE_POLL_INTERVAL = 5
+ENSEMBLE_MIN_CHAINS = 50
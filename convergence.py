@@ -0,0 +1,129 @@
+import numpy as np
+
+import constants
+
+
+class BatchMeans:
+    # Streaming batch-means estimate of the statistical error of a time average.
+    # Batches are fed as the sums of consecutive, equally long stretches of the
+    # chain; once 2 * number_of_batches batches are stored, neighbouring batches are
+    # merged and the batch size doubles, so memory stays bounded while the batches
+    # grow longer than the autocorrelation time of the chain.
+    def __init__(self, batch_size, number_of_batches=constants.NUMBER_OF_BATCHES):
+        self.batch_size = batch_size
+        self.number_of_batches = number_of_batches
+        self.batch_means = []
+        self.steps = 0
+        self.sum = 0
+        self.square_sum = 0
+
+    @property
+    def expected_value(self):
+        return self.sum / self.steps
+
+    @property
+    def variance(self):
+        return self.square_sum / self.steps - self.expected_value ** 2
+
+    @property
+    def standard_error(self):
+        if len(self.batch_means) < 2:
+            return float("inf")
+        return float(np.std(self.batch_means, ddof=1) / np.sqrt(len(self.batch_means)))
+
+    @property
+    def integrated_autocorrelation_time(self):
+        # In steps, normalized so that an uncorrelated chain has a time of 1
+        if len(self.batch_means) < 2 or self.variance <= 0:
+            return float("nan")
+        return float(
+            self.batch_size * np.var(self.batch_means, ddof=1) / self.variance
+        )
+
+    def add_batch(self, batch_sum, batch_square_sum, steps):
+        self.batch_means.append(batch_sum / steps)
+        self.steps += steps
+        self.sum += batch_sum
+        self.square_sum += batch_square_sum
+        if len(self.batch_means) == 2 * self.number_of_batches:
+            self.batch_means = [
+                (first + second) / 2
+                for first, second in zip(
+                    self.batch_means[::2], self.batch_means[1::2]
+                )
+            ]
+            self.batch_size *= 2
+
+    def has_converged(self, stop_condition):
+        if len(self.batch_means) < self.number_of_batches:
+            return False
+        # Batches shorter than the autocorrelation time of the chain underestimate
+        # the error, so small starting batches first have to outgrow it
+        if not (
+            self.batch_size
+            >= constants.BATCH_CORRELATION_TIMES * self.integrated_autocorrelation_time
+        ):
+            return False
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (
+                np.divide(self.standard_error, abs(self.expected_value))
+                <= stop_condition
+            )
+
+
+class BatchArrays:
+    # Batch means of a vector quantity, merged in pairs like BatchMeans, for
+    # delete-one-batch jackknife errors of functions of its mean
+    def __init__(self, batch_size, size, number_of_batches=constants.NUMBER_OF_BATCHES):
+        self.batch_size = batch_size
+        self.number_of_batches = number_of_batches
+        self.batch_means = np.zeros((0, size))
+
+    @property
+    def mean(self):
+        return self.batch_means.mean(axis=0)
+
+    @property
+    def jackknife_means(self):
+        # Row j is the mean of every batch except batch j
+        batches = len(self.batch_means)
+        return (self.batch_means.sum(axis=0) - self.batch_means) / (batches - 1)
+
+    def add_batch(self, batch_sums, steps):
+        self.batch_means = np.vstack(
+            [self.batch_means, np.asarray(batch_sums, dtype=np.float64) / steps]
+        )
+        if len(self.batch_means) == 2 * self.number_of_batches:
+            self.batch_means = (self.batch_means[::2] + self.batch_means[1::2]) / 2
+            self.batch_size *= 2
+
+
+def get_jackknife_error(estimates):
+    estimates = np.asarray(estimates)
+    if len(estimates) < 2:
+        return float("inf")
+    return float(np.sqrt((len(estimates) - 1) * np.var(estimates, axis=0)))
+
+
+class BatchCovariance(BatchArrays):
+    # Batches of x, y and x * y for the jackknife error of Cov(x, y)
+    def __init__(self, batch_size, number_of_batches=constants.NUMBER_OF_BATCHES):
+        super().__init__(batch_size, 3, number_of_batches)
+
+    @property
+    def covariance(self):
+        return _get_covariances(self.mean)
+
+    @property
+    def standard_error(self):
+        if len(self.batch_means) < 2:
+            return float("inf")
+        return get_jackknife_error(_get_covariances(self.jackknife_means))
+
+    def add_batch(self, x_sum, y_sum, product_sum, steps):
+        super().add_batch([x_sum, y_sum, product_sum], steps)
+
+
+def _get_covariances(means):
+    means = np.asarray(means)
+    return means[..., 2] - means[..., 0] * means[..., 1]
@@ -1,3 +1,4 @@
+import multiprocessing
 import pathlib
 
 import click
@@ -5,37 +6,185 @@ import click_pathlib
 import json
 import numpy as np
 
+import store
+
 
 @click.command()
 @click.argument("in_path", type=click_pathlib.Path(exists=True))
 @click.argument("out_path", type=click_pathlib.Path(exists=False))
-def main(in_path: pathlib.Path, out_path: pathlib.Path):
+@click.option(
+    "--format",
+    "out_format",
+    type=click.Choice(["json", "npz", "sqlite"]),
+    default="json",
+)
+@click.option("--processes", "-p", type=int, default=1)
+def main(in_path: pathlib.Path, out_path: pathlib.Path, out_format, processes):
+    files = sorted(file for file in in_path.iterdir() if file.is_file())
     number_of_particles_to_data = {}
-    for file in in_path.iterdir():
+    invalid_files = {}
+    with multiprocessing.Pool(processes=processes) as pool:
+        for file, number_of_particles, data, error in pool.imap_unordered(
+            _convert_file, files
+        ):
+            print(file.as_posix())
+            if error is not None:
+                invalid_files[file.as_posix()] = error
+                continue
+            number_of_particles_to_data[number_of_particles] = data
+
+    if out_format == "json":
+        _write_json(out_path, number_of_particles_to_data)
+    elif out_format == "npz":
+        _write_npz(out_path, number_of_particles_to_data)
+    else:
+        _write_store(out_path, number_of_particles_to_data)
+
+    _print_summary(files, number_of_particles_to_data, invalid_files)
+
+
+def _convert_file(file: pathlib.Path):
+    # Every field is read and checked here, so that a broken file is reported in
+    # the summary instead of failing the whole conversion
+    try:
         with file.open("rt") as fd:
             old_data = json.load(fd)
-        print(file.as_posix())
-        for expected_value, second_moment in zip(
-                old_data["N_0_avgs"], old_data["N_0_2_avgs"],
-        ):
-            try:
-                np.sqrt(float(second_moment) - np.square(float(expected_value)))
-            except Exception:
-                import ipdb; ipdb.set_trace()
-        number_of_particles_to_data[int(file.stem)] = {
-            "temperatures": old_data["T_s"],
-            "ground_state_expected_values": old_data["N_0_avgs"],
-            "ground_state_second_moment": old_data["N_0_2_avgs"],
+        number_of_particles = int(file.stem)
+        temperatures = np.asarray(old_data["T_s"], dtype=np.float64)
+        expected_values = np.asarray(old_data["N_0_avgs"], dtype=np.float64)
+        second_moments = np.asarray(old_data["N_0_2_avgs"], dtype=np.float64)
+        total_energies = np.asarray(old_data["U_tot_avgs"], dtype=np.float64)
+        shapes = {
+            "T_s": temperatures.shape,
+            "N_0_avgs": expected_values.shape,
+            "N_0_2_avgs": second_moments.shape,
+            "U_tot_avgs": total_energies.shape,
+        }
+        if temperatures.ndim != 1 or len(set(shapes.values())) != 1:
+            raise ValueError(f"fields of different shapes {shapes}")
+    except (ValueError, KeyError, TypeError) as error:
+        return file, None, None, f"{type(error).__name__}: {error}"
+
+    variances = second_moments - np.square(expected_values)
+    invalid = ~np.isfinite(variances) | (variances < 0)
+    stds = np.sqrt(np.where(invalid, np.nan, variances))
+    return (
+        file,
+        number_of_particles,
+        {
+            "temperatures": temperatures.tolist(),
+            "ground_state_expected_values": expected_values.tolist(),
+            "ground_state_second_moment": second_moments.tolist(),
             "ground_state_stds": [
-                np.sqrt(float(second_moment) - np.square(float(expected_value)))
-                for expected_value, second_moment in zip(
-                    old_data["N_0_avgs"], old_data["N_0_2_avgs"],
-                )
+                None if np.isnan(std) else float(std) for std in stds
             ],
-            "total_energy_expected_values": old_data["U_tot_avgs"],
-        }
-    with out_path.open('wt') as fd:
-        json.dump(number_of_particles_to_data, fd, indent=4)
+            "total_energy_expected_values": total_energies.tolist(),
+            "invalid_entries": [
+                {
+                    "temperature": float(temperatures[index]),
+                    "expected_value": float(expected_values[index]),
+                    "second_moment": float(second_moments[index]),
+                    "variance": float(variances[index]),
+                }
+                for index in np.flatnonzero(invalid)
+            ],
+        },
+        None,
+    )
+
+
+def _write_json(out_path: pathlib.Path, number_of_particles_to_data):
+    with out_path.open("wt") as fd:
+        json.dump(
+            {
+                number_of_particles: {
+                    key: value
+                    for key, value in data.items()
+                    if key != "invalid_entries"
+                }
+                for number_of_particles, data in sorted(
+                    number_of_particles_to_data.items()
+                )
+            },
+            fd,
+            indent=4,
+        )
+
+
+def _write_npz(out_path: pathlib.Path, number_of_particles_to_data):
+    # One row per (number of particles, temperature), invalid stds are NaN
+    columns = {
+        "number_of_particles": [],
+        "temperature": [],
+        "ground_state_expected_value": [],
+        "ground_state_second_moment": [],
+        "ground_state_std": [],
+        "total_energy_expected_value": [],
+    }
+    for number_of_particles, data in sorted(number_of_particles_to_data.items()):
+        columns["number_of_particles"].extend(
+            [number_of_particles] * len(data["temperatures"])
+        )
+        columns["temperature"].extend(data["temperatures"])
+        columns["ground_state_expected_value"].extend(
+            data["ground_state_expected_values"]
+        )
+        columns["ground_state_second_moment"].extend(data["ground_state_second_moment"])
+        columns["ground_state_std"].extend(
+            np.nan if std is None else std for std in data["ground_state_stds"]
+        )
+        columns["total_energy_expected_value"].extend(
+            data["total_energy_expected_values"]
+        )
+    np.savez_compressed(
+        out_path,
+        **{
+            name: np.asarray(values, dtype=np.float64)
+            for name, values in columns.items()
+        },
+    )
+
+
+def _write_store(out_path: pathlib.Path, number_of_particles_to_data):
+    with store.ResultStore(out_path) as result_store:
+        for number_of_particles, data in sorted(number_of_particles_to_data.items()):
+            for index, temperature in enumerate(data["temperatures"]):
+                result_store.add(
+                    number_of_particles,
+                    float(temperature),
+                    "legacy",
+                    {
+                        "ground_state_expected_value": float(
+                            data["ground_state_expected_values"][index]
+                        ),
+                        "ground_state_std": data["ground_state_stds"][index],
+                        "total_energy_expected_value": float(
+                            data["total_energy_expected_values"][index]
+                        ),
+                        "total_energy_std": None,
+                    },
+                    extra={
+                        "ground_state_second_moment": float(
+                            data["ground_state_second_moment"][index]
+                        )
+                    },
+                )
+
+
+def _print_summary(files, number_of_particles_to_data, invalid_files):
+    print(
+        f"Converted {len(number_of_particles_to_data)} of {len(files)} files"
+    )
+    for file, error in sorted(invalid_files.items()):
+        print(f"Skipped {file}: {error}")
+    for number_of_particles, data in sorted(number_of_particles_to_data.items()):
+        for entry in data["invalid_entries"]:
+            print(
+                f"Invalid entry for {number_of_particles} particles at temperature "
+                f"{entry['temperature']}: variance {entry['variance']} "
+                f"(expected value {entry['expected_value']}, "
+                f"second moment {entry['second_moment']})"
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,360 @@
+import logging
+
+import numpy as np
+
+import calculations
+import constants
+import model
+
+
+class Ensemble:
+    # Advances one chain per (temperature, replica) in lock-step. Every chain runs
+    # the same dynamics as model.Run and the same half/full doubling test as
+    # model.Model.run, but the occupancies of all chains live in 2D arrays and each
+    # step moves one particle of every active chain with vectorized operations.
+    # Chains retire as soon as their own stop condition is met. A vectorized step
+    # costs about the same however few chains are left, so below
+    # ENSEMBLE_MIN_CHAINS active chains the rest continue one by one as
+    # model.BlockRun chains from their current state.
+    def __init__(
+        self,
+        number_of_particles,
+        temperatures,
+        stop_conditions,
+        replicas=1,
+        max_energy_level=constants.MAX_ENERGY_LEVEL,
+        block_size=constants.BLOCK_SIZE,
+        seed=None,
+    ):
+        self.number_of_particles = int(number_of_particles)
+        self.temperatures = list(temperatures)
+        self.replicas = replicas
+        self.max_energy_level = max_energy_level
+        self.block_size = block_size
+        # The chains advance together on one vectorized stream, derived from the
+        # seed of the sweep and the number of particles
+        self.seed = seed
+        self.seed_sequence = np.random.SeedSequence(
+            seed, spawn_key=(self.number_of_particles,)
+        )
+        self.rng = np.random.default_rng(self.seed_sequence)
+        self.chain_runs = {}
+
+        self.mus = [
+            float(mu)
+            for mu in calculations.find_mus(self.temperatures, number_of_particles)
+        ]
+        self.chain_temperatures = np.repeat(self.temperatures, replicas)
+        self.chain_mus = np.repeat(self.mus, replicas)
+        self.chain_stop_conditions = np.repeat(stop_conditions, replicas)
+        number_of_chains = len(self.chain_temperatures)
+
+        self.decrease_probabilities = calculations.get_decrease_probability_tables(
+            self.chain_mus, self.chain_temperatures, max_energy_level
+        )
+        # Uniform over the active levels of model.Particles, leaving the top one
+        # empty unless it is the last level
+        highest_levels = np.array(
+            [
+                calculations.get_top_energy_level(
+                    mu, temperature, self.number_of_particles, max_energy_level
+                )
+                for mu, temperature in zip(self.chain_mus, self.chain_temperatures)
+            ]
+        )
+        highest_levels[highest_levels < max_energy_level] -= 1
+        self.particle_levels = self.rng.integers(
+            0,
+            highest_levels[:, None] + 1,
+            size=(number_of_chains, self.number_of_particles),
+            dtype=np.int64,
+        )
+        self.occurrences = np.zeros(
+            (number_of_chains, max_energy_level + 1), dtype=np.int64
+        )
+        for chain, particle_levels in enumerate(self.particle_levels):
+            self.occurrences[chain] = np.bincount(
+                particle_levels, minlength=max_energy_level + 1
+            )
+        self.energies = self.particle_levels.sum(axis=1)
+
+        # Means and sums of squared deviations of every chain, merged block by
+        # block with Chan's update like model.LevelStatistics. Float raw square
+        # sums would cancel in the variance over long chains.
+        self.steps = np.zeros(number_of_chains, dtype=np.int64)
+        self.ground_state_means = np.zeros(number_of_chains, dtype=np.float64)
+        self.ground_state_square_deviations = np.zeros(
+            number_of_chains, dtype=np.float64
+        )
+        self.total_energy_means = np.zeros(number_of_chains, dtype=np.float64)
+        self.total_energy_square_deviations = np.zeros(
+            number_of_chains, dtype=np.float64
+        )
+        self.active = np.ones(number_of_chains, dtype=bool)
+
+    @property
+    def number_of_chains(self):
+        return len(self.chain_temperatures)
+
+    def run(self):
+        self.burn_in()
+        steps = int(self.number_of_particles * 1e2 // 2)
+        while self.active.any():
+            steps *= 2
+            if steps > constants.MAX_STEPS:
+                logging.info(
+                    f"Max steps reached: {steps} ({self.active.sum()} chains still running)"
+                )
+                break
+
+            chains = np.flatnonzero(self.active)
+            logging.info(f"Running {steps:.0e} steps on {len(chains)} chains")
+            self.run_steps(chains, steps // 2)
+            half_expected_values = self._get_ground_state_expected_values(chains)
+            self.run_steps(chains, steps // 2)
+            full_expected_values = self._get_ground_state_expected_values(chains)
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                converged = (
+                    np.abs(full_expected_values - half_expected_values)
+                    / full_expected_values
+                    <= self.chain_stop_conditions[chains]
+                )
+            self.active[chains[converged]] = False
+
+        return self.get_results()
+
+    def burn_in(self):
+        # Like model.Model._burn_in: every chain runs until the mean energy of
+        # consecutive sweeps stops drifting in its initial direction, then its
+        # accumulators start over
+        sweep_steps = max(1, int(self.number_of_particles * constants.BURN_IN_SWEEPS))
+        previous_energies = np.full(self.number_of_chains, np.nan)
+        directions = np.zeros(self.number_of_chains)
+        burning = np.ones(self.number_of_chains, dtype=bool)
+        burn_in_steps = 0
+        while burning.any() and burn_in_steps < constants.MAX_STEPS:
+            chains = np.flatnonzero(burning)
+            self.run_steps(chains, sweep_steps)
+            burn_in_steps += sweep_steps
+            energies = self.total_energy_means[chains]
+            changes = np.sign(energies - previous_energies[chains])
+            started = ~np.isnan(previous_energies[chains])
+            turned = started & (directions[chains] != 0) & (changes != directions[chains])
+            directions[chains] = np.where(
+                started & (directions[chains] == 0), changes, directions[chains]
+            )
+            previous_energies[chains] = energies
+            burning[chains[turned]] = False
+            self._reset(chains)
+        logging.info(f"Burned in for up to {burn_in_steps:.0e} steps")
+        self._reset(np.arange(self.number_of_chains))
+
+    def _reset(self, chains):
+        for accumulator in [
+            self.steps,
+            self.ground_state_means,
+            self.ground_state_square_deviations,
+            self.total_energy_means,
+            self.total_energy_square_deviations,
+        ]:
+            accumulator[chains] = 0
+
+    def run_steps(self, chains, steps):
+        if len(chains) < constants.ENSEMBLE_MIN_CHAINS:
+            for chain in chains:
+                self._run_chain_steps(chain, steps)
+            return
+
+        number_of_levels = self.max_energy_level + 1
+        # Flat views with a per-chain offset are much cheaper to index than 2D
+        # fancy indexing in the per-step loop
+        particle_levels = self.particle_levels[chains].ravel()
+        occurrences = self.occurrences[chains].ravel()
+        decrease_probabilities = self.decrease_probabilities[chains].ravel()
+        energies = self.energies[chains]
+        particle_offsets = np.arange(len(chains)) * self.number_of_particles
+        level_offsets = np.arange(len(chains)) * number_of_levels
+        ground_state_indices = level_offsets
+        ground_state_trace = np.empty((self.block_size, len(chains)), dtype=np.int64)
+        energy_trace = np.empty((self.block_size, len(chains)), dtype=np.int64)
+
+        while steps > 0:
+            block_size = min(steps, self.block_size)
+            particle_indices = (
+                self.rng.integers(
+                    0, self.number_of_particles, size=(block_size, len(chains))
+                )
+                + particle_offsets
+            )
+            random_numbers = self.rng.random((block_size, len(chains)))
+            for step in range(block_size):
+                indices = particle_indices[step]
+                energy_levels = particle_levels[indices]
+                level_indices = energy_levels + level_offsets
+                decrease = random_numbers[step] <= decrease_probabilities[level_indices]
+                moves = (
+                    ~decrease & (energy_levels != self.max_energy_level)
+                ).astype(np.int64) - (decrease & (energy_levels != 0))
+                occurrences[level_indices] -= 1
+                occurrences[level_indices + moves] += 1
+                particle_levels[indices] = energy_levels + moves
+                energies += moves
+                ground_state_trace[step] = occurrences[ground_state_indices]
+                energy_trace[step] = energies
+
+            self._add_block(
+                chains, ground_state_trace[:block_size], energy_trace[:block_size]
+            )
+            steps -= block_size
+
+        self.particle_levels[chains] = particle_levels.reshape(len(chains), -1)
+        self.occurrences[chains] = occurrences.reshape(len(chains), -1)
+        self.energies[chains] = energies
+
+    def _run_chain_steps(self, chain, steps):
+        run = self.chain_runs.get(chain)
+        if run is None:
+            run = model.BlockRun(
+                temperature=self.chain_temperatures[chain],
+                max_energy_level=self.max_energy_level,
+                number_of_particles=self.number_of_particles,
+                mu=self.chain_mus[chain],
+                rng=np.random.default_rng(self.seed_sequence.spawn(1)[0]),
+                block_size=self.block_size,
+            )
+            run.set_occurrences(self.occurrences[chain])
+            self.chain_runs[chain] = run
+        data = run.data
+        before = self._get_run_sums(data)
+        run.run_steps(steps)
+        after = self._get_run_sums(data)
+        # The sums of the run are exact integers, so the moments of the steps just
+        # run follow from their differences without cancellation
+        (
+            run_steps,
+            ground_state_sum,
+            ground_state_square_sum,
+            energy_sum,
+            energy_square_sum,
+        ) = (end - start for end, start in zip(after, before))
+        if run_steps:
+            self._merge(
+                [chain],
+                run_steps,
+                ground_state_sum / run_steps,
+                (run_steps * ground_state_square_sum - ground_state_sum ** 2)
+                / run_steps,
+                energy_sum / run_steps,
+                (run_steps * energy_square_sum - energy_sum ** 2) / run_steps,
+            )
+        self.particle_levels[chain] = run.particle_levels
+        self.occurrences[chain] = run.occurrences
+        self.energies[chain] = run.energy
+
+    @staticmethod
+    def _get_run_sums(data):
+        return [
+            data.steps,
+            data.ground_level.sum,
+            data.ground_level.square_sum,
+            data.total_energy_sum,
+            data.total_energy_square_sum,
+        ]
+
+    def _add_block(self, chains, ground_state_trace, energy_trace):
+        ground_state_trace = ground_state_trace.astype(np.float64)
+        energy_trace = energy_trace.astype(np.float64)
+        ground_state_means = ground_state_trace.mean(axis=0)
+        energy_means = energy_trace.mean(axis=0)
+        self._merge(
+            chains,
+            len(ground_state_trace),
+            ground_state_means,
+            np.square(ground_state_trace - ground_state_means).sum(axis=0),
+            energy_means,
+            np.square(energy_trace - energy_means).sum(axis=0),
+        )
+
+    def _merge(
+        self,
+        chains,
+        steps,
+        ground_state_means,
+        ground_state_square_deviations,
+        energy_means,
+        energy_square_deviations,
+    ):
+        previous_steps = self.steps[chains]
+        total_steps = previous_steps + steps
+        for means, square_deviations, block_means, block_square_deviations in [
+            (
+                self.ground_state_means,
+                self.ground_state_square_deviations,
+                ground_state_means,
+                ground_state_square_deviations,
+            ),
+            (
+                self.total_energy_means,
+                self.total_energy_square_deviations,
+                energy_means,
+                energy_square_deviations,
+            ),
+        ]:
+            delta = block_means - means[chains]
+            means[chains] += delta * (steps / total_steps)
+            square_deviations[chains] += block_square_deviations + np.square(
+                delta
+            ) * (previous_steps * steps / total_steps)
+        self.steps[chains] = total_steps
+
+    def get_results(self):
+        # One model.RunData per temperature, with the replicas of each temperature
+        # merged into a single set of accumulators
+        results = []
+        for index, (temperature, mu) in enumerate(zip(self.temperatures, self.mus)):
+            chains = slice(index * self.replicas, (index + 1) * self.replicas)
+            chain_steps = self.steps[chains].astype(np.float64)
+            steps = int(self.steps[chains].sum())
+            ground_state_mean, ground_state_square_deviation = _merge_chains(
+                chain_steps,
+                self.ground_state_means[chains],
+                self.ground_state_square_deviations[chains],
+            )
+            energy_mean, energy_square_deviation = _merge_chains(
+                chain_steps,
+                self.total_energy_means[chains],
+                self.total_energy_square_deviations[chains],
+            )
+            results.append(
+                model.RunData(
+                    temperature=temperature,
+                    mu=mu,
+                    ground_level=model.EnergyLevel(
+                        level=0,
+                        sum=ground_state_mean * steps,
+                        square_sum=ground_state_square_deviation
+                        + ground_state_mean ** 2 * steps,
+                        add_count=steps,
+                        square_deviation=ground_state_square_deviation,
+                    ),
+                    steps=steps,
+                    total_energy_sum=energy_mean * steps,
+                    total_energy_square_sum=energy_square_deviation
+                    + energy_mean ** 2 * steps,
+                    total_energy_square_deviation=energy_square_deviation,
+                )
+            )
+        return results
+
+    def _get_ground_state_expected_values(self, chains):
+        return self.ground_state_means[chains]
+
+
+def _merge_chains(steps, means, square_deviations):
+    # Chan's update over several chains at once
+    mean = float(np.dot(steps, means) / steps.sum())
+    square_deviation = float(
+        square_deviations.sum() + np.dot(steps, np.square(means - mean))
+    )
+    return mean, square_deviation
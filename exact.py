@@ -0,0 +1,135 @@
+import numpy as np
+
+import calculations
+import constants
+
+# Recursion tables of every (temperature, max energy level), extended on demand
+_tables = {}
+
+OBSERVABLES = [
+    "ground_state_expected_value",
+    "ground_state_std",
+    "total_energy_expected_value",
+    "total_energy_std",
+    "heat_capacity",
+]
+
+
+def get_observables(
+    number_of_particles, temperatures, max_energy_level=constants.MAX_ENERGY_LEVEL
+):
+    # Canonical ensemble of N bosons on the levels n = 0..max_energy_level with
+    # degeneracies g(n). One dict of arrays over the temperatures.
+    number_of_particles = int(number_of_particles)
+    temperatures = np.asarray(temperatures, dtype=np.float64)
+    keys = [(float(temperature), int(max_energy_level)) for temperature in temperatures]
+    missing = [
+        key
+        for key in dict.fromkeys(keys)
+        if key not in _tables or len(_tables[key]["log_z"]) <= number_of_particles
+    ]
+    if missing:
+        tables = _build_tables(
+            [temperature for temperature, _ in missing],
+            number_of_particles,
+            max_energy_level,
+        )
+        for index, key in enumerate(missing):
+            _tables[key] = {name: table[index] for name, table in tables.items()}
+
+    N = number_of_particles
+    columns = {name: [] for name in OBSERVABLES}
+    for key, temperature in zip(keys, temperatures):
+        table = _tables[key]
+        log_z = table["log_z"]
+        # <N0> = sum_k Z_(N-k) / Z_N and <N0^2> = sum_k (2k - 1) Z_(N-k) / Z_N
+        ratios = np.exp(log_z[N - 1 :: -1] - log_z[N]) if N else np.zeros(0)
+        k = np.arange(1, N + 1)
+        ground_state = ratios.sum()
+        ground_state_second_moment = ((2 * k - 1) * ratios).sum()
+        energy = table["energy"][N]
+        energy_variance = max(table["energy_second_moment"][N] - energy ** 2, 0)
+        columns["ground_state_expected_value"].append(ground_state)
+        columns["ground_state_std"].append(
+            np.sqrt(max(ground_state_second_moment - ground_state ** 2, 0))
+        )
+        columns["total_energy_expected_value"].append(energy)
+        columns["total_energy_std"].append(np.sqrt(energy_variance))
+        columns["heat_capacity"].append(energy_variance / temperature ** 2)
+    return {name: np.array(values) for name, values in columns.items()}
+
+
+def get_stationary_observables(number_of_particles, temperature, mu=None):
+    # What the simulation converges to: its particles are independent, each with
+    # the stationary distribution of the single particle birth-death chain. This
+    # is not the canonical ensemble above. The heat capacity is dE/dT at fixed N,
+    # the covariance of the energy with the score of calculations.
+    if mu is None:
+        mu = calculations.find_mu(temperature, number_of_particles)
+    log_probabilities = calculations.get_stationary_log_probabilities(mu, temperature)
+    observables = calculations.get_independent_particle_observables(
+        log_probabilities, number_of_particles
+    )
+    probabilities = np.exp(log_probabilities)
+    levels = np.arange(len(probabilities))
+    scores = calculations.get_heat_capacity_score_table(
+        temperature, number_of_particles
+    )
+    observables["heat_capacity"] = number_of_particles * (
+        probabilities @ (levels * scores)
+        - (probabilities @ levels) * (probabilities @ scores)
+    )
+    return {name: float(value) for name, value in observables.items()}
+
+
+def _build_tables(temperatures, number_of_particles, max_energy_level):
+    # Z_N = (1 / N) sum_k C_k Z_(N-k), with C_k the single particle partition
+    # function at k * beta. Kept in logs, with the energy moments carried along as
+    # expectations so that nothing overflows:
+    #   U_N = sum_k w_k (k e_k + U_(N-k)),
+    #   <E^2>_N = sum_k w_k (k^2 s_k + 2 k e_k U_(N-k) + <E^2>_(N-k)),
+    # where w_k = C_k Z_(N-k) / (N Z_N), and e_k and s_k are the first and second
+    # single particle energy moments at k * beta. One row per temperature.
+    N = number_of_particles
+    beta = 1 / np.asarray(temperatures, dtype=np.float64)
+    n = np.arange(max_energy_level + 1)
+    k = np.arange(1, N + 1)
+    log_c = np.empty((len(beta), N))
+    e = np.empty((len(beta), N))
+    s = np.empty((len(beta), N))
+    for index, temperature_beta in enumerate(beta):
+        log_terms = np.log(calculations.g(n)) - np.outer(k * temperature_beta, n)
+        log_c[index] = np.logaddexp.reduce(log_terms, axis=1)
+        weights = np.exp(log_terms - log_c[index, :, None])
+        e[index] = weights @ n
+        s[index] = weights @ np.square(n)
+    # Stored from k = N down to 1, so that the terms of Z_m are the contiguous
+    # slices [N - m:] paired with Z_0..Z_(m-1)
+    log_c = log_c[:, ::-1].copy()
+    ke = (k * e)[:, ::-1].copy()
+    k2s = (np.square(k) * s)[:, ::-1].copy()
+
+    log_z = np.zeros((len(beta), N + 1))
+    energy = np.zeros((len(beta), N + 1))
+    energy_second_moment = np.zeros((len(beta), N + 1))
+    for m in range(1, N + 1):
+        log_terms = log_c[:, N - m :] + log_z[:, :m]
+        shift = log_terms.max(axis=1, keepdims=True)
+        w = np.exp(log_terms - shift)
+        total = w.sum(axis=1)
+        log_z[:, m] = shift[:, 0] + np.log(total / m)
+        w /= total[:, None]
+        previous_energy = energy[:, :m]
+        energy[:, m] = np.einsum("ij,ij->i", w, ke[:, N - m :] + previous_energy)
+        energy_second_moment[:, m] = np.einsum(
+            "ij,ij->i",
+            w,
+            k2s[:, N - m :]
+            + 2 * ke[:, N - m :] * previous_energy
+            + energy_second_moment[:, :m],
+        )
+    return {
+        "log_z": log_z,
+        "energy": energy,
+        "energy_second_moment": energy_second_moment,
+    }
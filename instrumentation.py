@@ -0,0 +1,50 @@
+import collections
+import contextlib
+import json
+import pathlib
+import time
+
+
+class Metrics:
+    # Counters and wall-clock timers of one job. They are touched once per chunk
+    # of steps, not per step, so they stay enabled in normal runs.
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.timers = collections.defaultdict(float)
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    @contextlib.contextmanager
+    def time(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.perf_counter() - start_time
+
+    def merge(self, metrics):
+        self.counters.update(metrics.counters)
+        for name, value in metrics.timers.items():
+            self.timers[name] += value
+
+    @property
+    def steps_per_second(self):
+        if not self.timers["stepping"]:
+            return None
+        return self.counters["steps"] / self.timers["stepping"]
+
+    def to_record(self, **fields):
+        return {
+            **fields,
+            **self.counters,
+            **{f"{name}_time": value for name, value in self.timers.items()},
+            "steps_per_second": self.steps_per_second,
+        }
+
+
+def write_records(path, records):
+    # JSON lines, appended so that records of several sweeps can share a file
+    with pathlib.Path(path).open("at") as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
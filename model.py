@@ -1,17 +1,24 @@
+import array
 import dataclasses
-import random
+import time
 import calculations
+import checkpoint
 import constants
+import convergence
+import instrumentation
 import logging
 import numpy as np
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class EnergyLevel:
     level: int
     sum: float = 0
     square_sum: float = 0
     add_count: int = 0
+    # Sum of the squared deviations from the mean, merged with Chan's update by
+    # accumulators whose sums are floats (ensemble.Ensemble), None otherwise
+    square_deviation: float = None
 
     @property
     def expected_value(self):
@@ -23,25 +30,135 @@ class EnergyLevel:
 
     @property
     def variance(self):
-        return self.second_momentum - self.expected_value ** 2
+        if self.square_deviation is not None:
+            return self.square_deviation / self.add_count
+        # The sums of the engines are exact integers, so the two raw moments only
+        # meet in a single rounding instead of cancelling as floats
+        return (self.add_count * self.square_sum - self.sum ** 2) / self.add_count ** 2
 
     @property
     def std(self):
         return self.variance ** 0.5
 
-    def add(self, occurrences):
-        self.sum += occurrences
-        self.square_sum += occurrences ** 2
-        self.add_count += 1
+    def add(self, occurrences, weight=1):
+        self.sum += weight * occurrences
+        self.square_sum += weight * occurrences ** 2
+        self.add_count += weight
+
+    def add_block(self, occurrences):
+        self.sum += int(np.sum(occurrences, dtype=np.int64))
+        self.square_sum += int(np.dot(occurrences, occurrences))
+        self.add_count += len(occurrences)
 
     def copy(self, energy_level):
         self.level = energy_level.level
         self.sum = energy_level.sum
         self.square_sum = energy_level.square_sum
         self.add_count = energy_level.add_count
+        self.square_deviation = energy_level.square_deviation
+
+
+class LevelStatistics:
+    # Mean and variance of the occupancy of every energy level. Blocks are reduced
+    # on their own and merged with Chan's parallel update, so the accumulators never
+    # subtract two large raw moments.
+    __slots__ = ("count", "means", "square_deviations")
+
+    def __init__(self, number_of_levels):
+        self.count = 0
+        self.means = np.zeros(number_of_levels, dtype=np.float64)
+        self.square_deviations = np.zeros(number_of_levels, dtype=np.float64)
+
+    @property
+    def expected_values(self):
+        return self.means.copy()
+
+    @property
+    def variances(self):
+        return self.square_deviations / self.count
+
+    @property
+    def stds(self):
+        return np.sqrt(self.variances)
+
+    def merge(self, count, means, square_deviations):
+        if count == 0:
+            return
+        total_count = self.count + count
+        delta = means - self.means
+        self.means += delta * (count / total_count)
+        self.square_deviations += (
+            square_deviations + np.square(delta) * (self.count * count / total_count)
+        )
+        self.count = total_count
 
+    def add_moves(self, occurrences, move_steps, from_levels, to_levels, steps):
+        # Updates the statistics with a block of steps given only the occupancies
+        # before the block and the real moves inside it. Every level keeps its
+        # occupancy between the moves touching it, so each level reduces to a few
+        # weighted constant segments instead of one value per step.
+        if steps == 0:
+            return
+        occurrences = np.asarray(occurrences, dtype=np.float64)
+        number_of_levels = len(occurrences)
+        move_steps = np.asarray(move_steps, dtype=np.int64)
+        levels = np.concatenate(
+            [
+                np.asarray(from_levels, dtype=np.int64),
+                np.asarray(to_levels, dtype=np.int64),
+            ]
+        )
+        deltas = np.concatenate(
+            [-np.ones(len(move_steps)), np.ones(len(move_steps))]
+        )
+        event_steps = np.concatenate([move_steps, move_steps])
+        order = np.lexsort((event_steps, levels))
+        levels, deltas, event_steps = levels[order], deltas[order], event_steps[order]
 
-@dataclasses.dataclass
+        first_of_level = np.ones(len(levels), dtype=bool)
+        first_of_level[1:] = levels[1:] != levels[:-1]
+        last_of_level = np.ones(len(levels), dtype=bool)
+        last_of_level[:-1] = first_of_level[1:]
+        cumulative_deltas = np.cumsum(deltas)
+        level_starts = np.flatnonzero(first_of_level)
+        level_offsets = (cumulative_deltas - deltas)[level_starts]
+        values = (
+            occurrences[levels]
+            + cumulative_deltas
+            - level_offsets[np.cumsum(first_of_level) - 1]
+        )
+        next_steps = np.append(event_steps[1:], steps)
+        next_steps[last_of_level] = steps
+        durations = next_steps - event_steps
+
+        first_event_steps = np.full(number_of_levels, steps, dtype=np.int64)
+        first_event_steps[levels[level_starts]] = event_steps[level_starts]
+        segment_levels = np.concatenate([np.arange(number_of_levels), levels])
+        segment_values = np.concatenate([occurrences, values])
+        segment_weights = np.concatenate([first_event_steps, durations])
+
+        means = (
+            np.bincount(
+                segment_levels,
+                weights=segment_weights * segment_values,
+                minlength=number_of_levels,
+            )
+            / steps
+        )
+        square_deviations = np.bincount(
+            segment_levels,
+            weights=segment_weights * np.square(segment_values - means[segment_levels]),
+            minlength=number_of_levels,
+        )
+        self.merge(steps, means, square_deviations)
+
+    def copy(self, statistics):
+        self.count = statistics.count
+        self.means[:] = statistics.means
+        self.square_deviations[:] = statistics.square_deviations
+
+
+@dataclasses.dataclass(slots=True)
 class RunData:
     temperature: float
     mu: float
@@ -49,6 +166,12 @@ class RunData:
     steps: int = 0
     total_energy_sum: int = 0
     total_energy_square_sum: int = 0
+    levels: LevelStatistics = None
+    # Sums of the heat capacity score S and of E * S, None unless tracked
+    score_sum: float = None
+    energy_score_sum: float = None
+    # See EnergyLevel.square_deviation
+    total_energy_square_deviation: float = None
 
     @property
     def total_energy_expected_value(self):
@@ -58,90 +181,359 @@ class RunData:
     def total_energy_second_momentum(self):
         return self.total_energy_square_sum / self.steps
 
+    @property
+    def total_energy_variance(self):
+        if self.total_energy_square_deviation is not None:
+            return self.total_energy_square_deviation / self.steps
+        return (
+            self.steps * self.total_energy_square_sum - self.total_energy_sum ** 2
+        ) / self.steps ** 2
+
     @property
     def total_energy_std(self):
-        return (self.total_energy_second_momentum - self.total_energy_expected_value ** 2) ** 0.5
+        return self.total_energy_variance ** 0.5
 
-    def add(self, ground_state_occurrences, total_energy):
-        self.total_energy_sum += total_energy
-        self.total_energy_square_sum += total_energy ** 2
-        self.steps += 1
-        self.ground_level.add(ground_state_occurrences)
+    @property
+    def ground_state_std(self):
+        # The level statistics are merged with Chan's update, when tracked
+        if self.levels is not None and self.levels.count:
+            return float(self.levels.stds[0])
+        return self.ground_level.std
+
+    @property
+    def heat_capacity(self):
+        if self.score_sum is None:
+            return None
+        return (
+            self.energy_score_sum / self.steps
+            - self.total_energy_expected_value * self.score_sum / self.steps
+        )
+
+    def add(self, ground_state_occurrences, total_energy, weight=1):
+        self.total_energy_sum += weight * total_energy
+        self.total_energy_square_sum += weight * total_energy ** 2
+        self.steps += weight
+        self.ground_level.add(ground_state_occurrences, weight)
+
+    def add_block(self, ground_state_occurrences, total_energies):
+        self.total_energy_sum += int(np.sum(total_energies, dtype=np.int64))
+        self.total_energy_square_sum += int(np.dot(total_energies, total_energies))
+        self.steps += len(total_energies)
+        self.ground_level.add_block(ground_state_occurrences)
+
+    def add_scores(
+        self, occurrences, move_steps, from_levels, to_levels, steps, score_table
+    ):
+        # The energy and the score only change at the real moves, so the block
+        # reduces to one constant segment before the first move and one after each
+        if steps == 0:
+            return
+        occurrences = np.asarray(occurrences, dtype=np.float64)
+        move_steps = np.asarray(move_steps, dtype=np.int64)
+        from_levels = np.asarray(from_levels, dtype=np.int64)
+        to_levels = np.asarray(to_levels, dtype=np.int64)
+        energies = np.dot(occurrences, np.arange(len(occurrences))) + np.concatenate(
+            [[0], np.cumsum(to_levels - from_levels)]
+        )
+        scores = np.dot(occurrences, score_table) + np.concatenate(
+            [[0], np.cumsum(score_table[to_levels] - score_table[from_levels])]
+        )
+        durations = np.diff(np.concatenate([[0], move_steps, [steps]]))
+        self.score_sum += float(np.dot(durations, scores))
+        self.energy_score_sum += float(np.dot(durations, energies * scores))
 
     def copy(self, attempt):
         self.steps = attempt.steps
         self.total_energy_sum = attempt.total_energy_sum
         self.total_energy_square_sum = attempt.total_energy_square_sum
+        self.score_sum = attempt.score_sum
+        self.energy_score_sum = attempt.energy_score_sum
+        self.total_energy_square_deviation = attempt.total_energy_square_deviation
         self.ground_level.copy(attempt.ground_level)
+        if self.levels is not None:
+            self.levels.copy(attempt.levels)
+
+
+class LevelSampler:
+    # Fenwick tree over the occupancy of every energy level, so picking the level
+    # of a uniformly chosen particle and moving a particle both cost O(log L)
+    __slots__ = ("size", "total", "tree", "_top_bit")
+
+    def __init__(self, occurrences):
+        self.size = len(occurrences)
+        self.total = 0
+        self.tree = [0] * (self.size + 1)
+        self._top_bit = 1 << (self.size.bit_length() - 1)
+        self.rebuild(occurrences)
+
+    def rebuild(self, occurrences):
+        self.total = sum(occurrences)
+        self.tree[0] = 0
+        self.tree[1:] = occurrences
+        for index in range(1, self.size + 1):
+            parent = index + (index & -index)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[index]
+
+    def copy(self, sampler):
+        self.size = sampler.size
+        self.total = sampler.total
+        self.tree[:] = sampler.tree
+        self._top_bit = sampler._top_bit
+
+    def add(self, energy_level, delta):
+        self.total += delta
+        index = energy_level + 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def move(self, from_energy_level, to_energy_level):
+        self.add(from_energy_level, -1)
+        self.add(to_energy_level, 1)
+
+    def find(self, target):
+        # Returns the level holding the particle with the given rank (0 <= target < total)
+        index = 0
+        bit = self._top_bit
+        tree = self.tree
+        while bit:
+            next_index = index + bit
+            if next_index <= self.size and tree[next_index] <= target:
+                index = next_index
+                target -= tree[next_index]
+            bit >>= 1
+        return index
 
 
 class Particles:
-    def __init__(self, max_energy_level, number_of_particles):
+    # The occupancies live in a fixed-size int64 array indexed by energy level, so
+    # copying a state is a single buffer copy and NumPy can view it without copying.
+    # Only the levels below top_energy_level are active: the initial condition and
+    # the sampler cover just them, and a particle reaching the top level doubles
+    # the range, up to max_energy_level. The top level stays empty until then, so
+    # the chain moves exactly as if every level were active.
+    __slots__ = (
+        "max_energy_level",
+        "top_energy_level",
+        "number_of_particles",
+        "verify_energy",
+        "energy_level_to_occurrences",
+        "sampler",
+        "ceiling_hits",
+        "_energy",
+    )
+
+    def __init__(
+        self,
+        max_energy_level,
+        number_of_particles,
+        rng,
+        verify_energy=False,
+        top_energy_level=None,
+    ):
         self.max_energy_level = max_energy_level
+        self.top_energy_level = (
+            max_energy_level if top_energy_level is None else top_energy_level
+        )
         self.number_of_particles = int(number_of_particles)
-        self._set_initial_condition(max_energy_level, self.number_of_particles)
+        self.verify_energy = verify_energy
+        # Moves onto max_energy_level, above which the chain is clipped
+        self.ceiling_hits = 0
+        self._set_initial_condition(max_energy_level, self.number_of_particles, rng)
+        self._energy = self._compute_energy()
+        self.sampler = self._create_sampler()
 
     def __str__(self):
-        return str(self.energy_level_to_occurrences)
+        return str(dict(enumerate(self.energy_level_to_occurrences)))
 
     def copy(self, particles):
         self.max_energy_level = particles.max_energy_level
+        self.top_energy_level = particles.top_energy_level
         self.number_of_particles = particles.number_of_particles
-        for energy_level, occurrences in particles.energy_level_to_occurrences.items():
-            self.energy_level_to_occurrences[energy_level] = occurrences
+        self.energy_level_to_occurrences[:] = particles.energy_level_to_occurrences
+        self.sampler.copy(particles.sampler)
+        self.ceiling_hits = particles.ceiling_hits
+        self._energy = particles._energy
+
+    def set_occurrences(self, occurrences):
+        self.energy_level_to_occurrences[:] = array.array("q", occurrences)
+        # Engines that move the particles on their own may have reached the top
+        # level in the meantime
+        while (
+            self.top_energy_level < self.max_energy_level
+            and self.energy_level_to_occurrences[self.top_energy_level]
+        ):
+            self.top_energy_level = min(self.max_energy_level, 2 * self.top_energy_level)
+        self.sampler = self._create_sampler()
+        self._energy = self._compute_energy()
+
+    def as_array(self):
+        return np.frombuffer(self.energy_level_to_occurrences, dtype=np.int64)
+
+    def get_random_energy_level(self, random_number):
+        return self.sampler.find(int(random_number * self.number_of_particles))
+
+    def move(self, from_energy_level, to_energy_level):
+        self.energy_level_to_occurrences[from_energy_level] -= 1
+        self.energy_level_to_occurrences[to_energy_level] += 1
+        self._energy += to_energy_level - from_energy_level
+        if to_energy_level != self.top_energy_level or not self.reach_top():
+            self.sampler.move(from_energy_level, to_energy_level)
+
+    def reach_top(self):
+        # Returns whether the active range grew, rebuilding the sampler from the
+        # current occurrences
+        if self.top_energy_level == self.max_energy_level:
+            self.ceiling_hits += 1
+            return False
+        self.top_energy_level = min(self.max_energy_level, 2 * self.top_energy_level)
+        self.sampler = self._create_sampler()
+        return True
 
     @property
     def energy(self):
+        if self.verify_energy:
+            computed_energy = self._compute_energy()
+            if computed_energy != self._energy:
+                raise RuntimeError(
+                    f"Running energy {self._energy} does not match the computed energy {computed_energy}"
+                )
+        return self._energy
+
+    def _compute_energy(self):
         return sum(
             energy_level * occurrences
-            for energy_level, occurrences in self.energy_level_to_occurrences.items()
+            for energy_level, occurrences in enumerate(self.energy_level_to_occurrences)
         )
 
-    def _set_initial_condition(self, max_energy_level, number_of_particles):
-        self.energy_level_to_occurrences = {
-            energy_level: 0 for energy_level in range(max_energy_level + 1)
-        }
-        for _ in range(number_of_particles):
-            self.energy_level_to_occurrences[random.randint(0, max_energy_level)] += 1
+    def _set_initial_condition(self, max_energy_level, number_of_particles, rng):
+        # Uniform over the active levels, leaving the top one empty unless it is
+        # the last level
+        highest_level = self.top_energy_level
+        if highest_level < max_energy_level:
+            highest_level -= 1
+        self.energy_level_to_occurrences = array.array(
+            "q",
+            np.bincount(
+                rng.integers(0, highest_level + 1, size=number_of_particles),
+                minlength=max_energy_level + 1,
+            ).tolist(),
+        )
+
+    def _create_sampler(self):
+        return LevelSampler(
+            self.energy_level_to_occurrences[: self.top_energy_level + 1]
+        )
+
+
+class RandomNumbers:
+    # Uniform numbers drawn from a Generator in bulk and handed out one at a time,
+    # for the engines that do not know up front how many numbers a step needs
+    __slots__ = ("rng", "size", "buffer", "index")
+
+    def __init__(self, rng, size=constants.BLOCK_SIZE):
+        self.rng = rng
+        self.size = size
+        self.buffer = []
+        self.index = 0
+
+    def random(self):
+        if self.index == len(self.buffer):
+            self.buffer = self.rng.random(self.size).tolist()
+            self.index = 0
+        self.index += 1
+        return self.buffer[self.index - 1]
+
+
+def get_seed_sequence(seed, number_of_particles, temperature, replica=0):
+    # One independent stream per (number of particles, temperature, replica), all
+    # derived from the seed of the sweep
+    return np.random.SeedSequence(
+        seed,
+        spawn_key=(int(number_of_particles), int(round(temperature * 1e6)), replica),
+    )
 
 
 class Run:
-    def __init__(self, temperature, max_energy_level, number_of_particles, mu):
+    def __init__(
+        self,
+        temperature,
+        max_energy_level,
+        number_of_particles,
+        mu,
+        verify_energy=False,
+        track_levels=False,
+        rng=None,
+        track_heat_capacity=False,
+        top_energy_level=None,
+    ):
         self.temperature = temperature
-        self.particles = Particles(max_energy_level, number_of_particles)
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.particles = Particles(
+            max_energy_level,
+            number_of_particles,
+            self.rng,
+            verify_energy=verify_energy,
+            top_energy_level=top_energy_level,
+        )
         self.data = RunData(
-            temperature=temperature, mu=mu, ground_level=EnergyLevel(level=0)
+            temperature=temperature,
+            mu=mu,
+            ground_level=EnergyLevel(level=0),
+            levels=LevelStatistics(max_energy_level + 1) if track_levels else None,
         )
-        self.energy_level_to_decrease_probability = {
-            energy_level: calculations.get_decrease_probability(
-                mu=mu, temperature=self.temperature, energy_level=energy_level
+        # Batch statistics of the batch-means test of Model, None when the run is
+        # stopped by the doubling test
+        self.convergence = None
+        self.heat_capacity_convergence = None
+        self.level_convergence = None
+        self.score_table = None
+        if track_heat_capacity:
+            self.score_table = calculations.get_heat_capacity_score_table(
+                temperature, number_of_particles, max_energy_level
             )
-            for energy_level in range(max_energy_level + 1)
-        }
+            self.data.score_sum = self.data.energy_score_sum = 0.0
+        self.decrease_probabilities = calculations.get_decrease_probability_table(
+            mu=mu, temperature=self.temperature, max_energy_level=max_energy_level
+        )
+        # Plain Python floats index faster than NumPy scalars in the per-step loop
+        self.energy_level_to_decrease_probability = self.decrease_probabilities.tolist()
 
     def __str__(self):
         return str(self.particles)
 
     def run_step(self):
-        energy_level = self._get_random_energy_level()
-        self._update_energy(energy_level)
-        self.data.add(
-            self.particles.energy_level_to_occurrences[0], self.particles.energy
+        self.run_steps(1)
+
+    def reset_data(self):
+        self.data = RunData(
+            temperature=self.temperature,
+            mu=self.data.mu,
+            ground_level=EnergyLevel(level=0),
+            levels=None
+            if self.data.levels is None
+            else LevelStatistics(len(self.data.levels.means)),
         )
+        if self.score_table is not None:
+            self.data.score_sum = self.data.energy_score_sum = 0.0
+
+    @property
+    def records_moves(self):
+        return self.data.levels is not None or self.score_table is not None
 
     def copy(self, run):
         self.temperature = run.temperature
         self.particles.copy(run.particles)
         self.data.copy(run.data)
 
-    def _get_random_energy_level(self):
-        energy_level = random.choices(
-            *zip(*self.particles.energy_level_to_occurrences.items())
-        )
-        return energy_level[0]
+    def swap_particles(self, run):
+        self.particles, run.particles = run.particles, self.particles
+
+    def set_occurrences(self, occurrences):
+        self.particles.set_occurrences(occurrences)
 
-    def _update_energy(self, energy_level):
-        random_number = random.random()
+    def _update_energy(self, energy_level, random_number):
         if random_number <= self.energy_level_to_decrease_probability[energy_level]:
             self._decrease_energy(energy_level)
         else:
@@ -150,66 +542,609 @@ class Run:
     def _increase_energy(self, energy_level):
         if energy_level == self.particles.max_energy_level:
             return
-        self.particles.energy_level_to_occurrences[energy_level] -= 1
-        self.particles.energy_level_to_occurrences[energy_level + 1] += 1
+        self.particles.move(energy_level, energy_level + 1)
 
     def _decrease_energy(self, energy_level):
         if energy_level == 0:
             return
-        self.particles.energy_level_to_occurrences[energy_level] -= 1
-        self.particles.energy_level_to_occurrences[energy_level - 1] += 1
+        self.particles.move(energy_level, energy_level - 1)
+
+    def run_steps(self, steps):
+        while steps > 0:
+            chunk_size = min(steps, constants.BLOCK_SIZE)
+            self._run_chunk(chunk_size)
+            steps -= chunk_size
+
+    def _run_chunk(self, steps):
+        # The two uniform numbers of every step, choosing the particle and the
+        # direction, are drawn for the whole chunk at once
+        particles = self.particles
+        level_numbers, direction_numbers = self.rng.random((2, steps)).tolist()
+        if not self.records_moves:
+            for level_number, direction_number in zip(level_numbers, direction_numbers):
+                self._update_energy(
+                    particles.get_random_energy_level(level_number), direction_number
+                )
+                self.data.add(particles.energy_level_to_occurrences[0], particles.energy)
+            return
+
+        # Every real move changes the energy by exactly one level, which tells
+        # where the chosen particle went
+        occurrences = particles.as_array().copy()
+        move_steps, from_levels, to_levels = [], [], []
+        for step, (level_number, direction_number) in enumerate(
+            zip(level_numbers, direction_numbers)
+        ):
+            energy_level = particles.get_random_energy_level(level_number)
+            energy = particles.energy
+            self._update_energy(energy_level, direction_number)
+            energy_change = particles.energy - energy
+            if energy_change:
+                move_steps.append(step)
+                from_levels.append(energy_level)
+                to_levels.append(energy_level + energy_change)
+            self.data.add(particles.energy_level_to_occurrences[0], particles.energy)
+        self._add_moves(occurrences, move_steps, from_levels, to_levels, steps)
+
+    def _add_moves(self, occurrences, move_steps, from_levels, to_levels, steps):
+        if self.data.levels is not None:
+            self.data.levels.add_moves(
+                occurrences, move_steps, from_levels, to_levels, steps
+            )
+        if self.score_table is not None:
+            self.data.add_scores(
+                occurrences, move_steps, from_levels, to_levels, steps, self.score_table
+            )
+
+
+class BlockRun(Run):
+    # Runs the same chain as Run, but draws the random numbers of a whole block up
+    # front and updates the accumulators once per block. The level of a uniformly
+    # chosen particle is looked up in a particle-indexed array, which is the same
+    # as choosing a level with probability proportional to its occupancy.
+    def __init__(
+        self,
+        temperature,
+        max_energy_level,
+        number_of_particles,
+        mu,
+        verify_energy=False,
+        track_levels=False,
+        rng=None,
+        track_heat_capacity=False,
+        top_energy_level=None,
+        block_size=constants.BLOCK_SIZE,
+    ):
+        super().__init__(
+            temperature=temperature,
+            max_energy_level=max_energy_level,
+            number_of_particles=number_of_particles,
+            mu=mu,
+            verify_energy=verify_energy,
+            track_levels=track_levels,
+            rng=rng,
+            track_heat_capacity=track_heat_capacity,
+            top_energy_level=top_energy_level,
+        )
+        self.block_size = block_size
+        self._load_particles()
+
+    def run_step(self):
+        self.run_steps(1)
+
+    def run_steps(self, steps):
+        while steps > 0:
+            block_size = min(steps, self.block_size)
+            self._run_block(block_size)
+            steps -= block_size
+        self._store_particles()
+
+    def copy(self, run):
+        super().copy(run)
+        self._load_particles()
+
+    def set_occurrences(self, occurrences):
+        super().set_occurrences(occurrences)
+        self._load_particles()
+
+    def swap_particles(self, run):
+        super().swap_particles(run)
+        self.occurrences, run.occurrences = run.occurrences, self.occurrences
+        self.particle_levels, run.particle_levels = (
+            run.particle_levels,
+            self.particle_levels,
+        )
+        self.energy, run.energy = run.energy, self.energy
+
+    def _load_particles(self):
+        self.occurrences = self.particles.as_array()
+        self.particle_levels = np.repeat(
+            np.arange(self.particles.max_energy_level + 1, dtype=np.int64),
+            self.occurrences,
+        )
+        self.energy = int(self.particle_levels.sum())
+
+    def _store_particles(self):
+        self.particles.set_occurrences(self.occurrences)
+
+    def _run_block(self, block_size):
+        number_of_particles = self.particles.number_of_particles
+        max_energy_level = self.particles.max_energy_level
+        particle_indices = self.rng.integers(0, number_of_particles, size=block_size)
+        random_numbers = self.rng.random(block_size)
+        # The decrease decision depends on the level at the time of the step, so it
+        # is resolved inside the loop; everything else is precomputed per block.
+        particle_levels = self.particle_levels.tolist()
+        occurrences = self.occurrences.tolist()
+        decrease_probabilities = self.energy_level_to_decrease_probability
+        ground_state_trace = [0] * block_size
+        energy_trace = [0] * block_size
+        level_trace = [0] * block_size
+        energy = self.energy
+        initial_energy = energy
+        initial_occurrences = self.occurrences.copy()
+        for step, (particle_index, random_number) in enumerate(
+            zip(particle_indices.tolist(), random_numbers.tolist())
+        ):
+            energy_level = particle_levels[particle_index]
+            if random_number <= decrease_probabilities[energy_level]:
+                if energy_level != 0:
+                    occurrences[energy_level] -= 1
+                    occurrences[energy_level - 1] += 1
+                    particle_levels[particle_index] = energy_level - 1
+                    energy -= 1
+            elif energy_level != max_energy_level:
+                occurrences[energy_level] -= 1
+                occurrences[energy_level + 1] += 1
+                particle_levels[particle_index] = energy_level + 1
+                energy += 1
+            ground_state_trace[step] = occurrences[0]
+            energy_trace[step] = energy
+            level_trace[step] = energy_level
+
+        total_energies = np.array(energy_trace, dtype=np.int64)
+        # A real move changes the energy by one, in the direction the particle
+        # taken from level_trace moved
+        energy_changes = np.diff(total_energies, prepend=initial_energy)
+        levels = np.array(level_trace, dtype=np.int64)
+        self.particles.ceiling_hits += int(
+            np.count_nonzero((levels == max_energy_level - 1) & (energy_changes > 0))
+        )
+        # The active range grows whenever a particle reaches its top, as in
+        # Particles.move, even if no particle is left there at the end of the run
+        up_moves = energy_changes > 0
+        if up_moves.any():
+            highest_level = int(levels[up_moves].max()) + 1
+            while (
+                self.particles.top_energy_level <= highest_level
+                and self.particles.top_energy_level < max_energy_level
+            ):
+                self.particles.reach_top()
+        if self.records_moves:
+            move_steps = np.flatnonzero(energy_changes)
+            from_levels = levels[move_steps]
+            self._add_moves(
+                initial_occurrences,
+                move_steps,
+                from_levels,
+                from_levels + energy_changes[move_steps],
+                block_size,
+            )
+        self.particle_levels[:] = particle_levels
+        self.occurrences[:] = occurrences
+        self.energy = energy
+        self.data.add_block(np.array(ground_state_trace, dtype=np.int64), total_energies)
+
+
+class RejectionFreeRun(Run):
+    # n-fold way: instead of proposing moves that do nothing (decreasing a particle
+    # on level 0 or increasing one on the top level), the number of such null steps
+    # before the next real move is drawn from a geometric distribution and the
+    # current state is recorded once with that many steps as its weight.
+    def __init__(
+        self,
+        temperature,
+        max_energy_level,
+        number_of_particles,
+        mu,
+        verify_energy=False,
+        track_levels=False,
+        rng=None,
+        track_heat_capacity=False,
+        top_energy_level=None,
+    ):
+        super().__init__(
+            temperature=temperature,
+            max_energy_level=max_energy_level,
+            number_of_particles=number_of_particles,
+            mu=mu,
+            verify_energy=verify_energy,
+            track_levels=track_levels,
+            rng=rng,
+            track_heat_capacity=track_heat_capacity,
+            top_energy_level=top_energy_level,
+        )
+        self.random_numbers = RandomNumbers(self.rng)
+        self.null_moves = 0
+
+    def run_step(self):
+        self.run_steps(1)
+
+    def run_steps(self, steps):
+        particles = self.particles
+        occurrences = particles.energy_level_to_occurrences
+        max_energy_level = particles.max_energy_level
+        ground_decrease_probability = self.energy_level_to_decrease_probability[0]
+        top_increase_probability = (
+            1 - self.energy_level_to_decrease_probability[max_energy_level]
+        )
+        initial_occurrences = particles.as_array().copy()
+        move_steps, from_levels, to_levels = [], [], []
+        step = 0
+        while step < steps:
+            null_probability = (
+                occurrences[0] * ground_decrease_probability
+                + occurrences[max_energy_level] * top_increase_probability
+            ) / particles.number_of_particles
+            null_steps = min(self._get_null_steps(null_probability), steps - step)
+            if null_steps:
+                self.data.add(occurrences[0], particles.energy, weight=null_steps)
+                self.null_moves += null_steps
+                step += null_steps
+            if step == steps:
+                break
+            from_level, to_level = self._run_real_move(null_probability)
+            if self.records_moves:
+                move_steps.append(step)
+                from_levels.append(from_level)
+                to_levels.append(to_level)
+            self.data.add(occurrences[0], particles.energy)
+            step += 1
+
+        if self.records_moves:
+            self._add_moves(
+                initial_occurrences, move_steps, from_levels, to_levels, steps
+            )
+
+    def _get_null_steps(self, null_probability):
+        if null_probability <= 0:
+            return 0
+        if null_probability >= 1:
+            return float("inf")
+        return int(
+            np.log(1 - self.random_numbers.random()) / np.log(null_probability)
+        )
+
+    def _run_real_move(self, null_probability):
+        particles = self.particles
+        occurrences = particles.energy_level_to_occurrences
+        max_energy_level = particles.max_energy_level
+        target = (
+            self.random_numbers.random()
+            * (1 - null_probability)
+            * particles.number_of_particles
+        )
+        ground_increase_weight = occurrences[0] * (
+            1 - self.energy_level_to_decrease_probability[0]
+        )
+        if target < ground_increase_weight:
+            particles.move(0, 1)
+            return 0, 1
+        target -= ground_increase_weight
+        top_decrease_weight = (
+            occurrences[max_energy_level]
+            * self.energy_level_to_decrease_probability[max_energy_level]
+        )
+        interior_particles = (
+            particles.number_of_particles
+            - occurrences[0]
+            - occurrences[max_energy_level]
+        )
+        if target < top_decrease_weight or interior_particles == 0:
+            particles.move(max_energy_level, max_energy_level - 1)
+            return max_energy_level, max_energy_level - 1
+        # Every other level moves on every proposal, so the remaining particle is
+        # chosen uniformly among the particles that are not on the boundary levels
+        energy_level = particles.sampler.find(
+            occurrences[0] + int(self.random_numbers.random() * interior_particles)
+        )
+        energy = particles.energy
+        self._update_energy(energy_level, self.random_numbers.random())
+        return energy_level, energy_level + particles.energy - energy
+
+
+ENGINES = {
+    "scalar": Run,
+    "block": BlockRun,
+    "rejection_free": RejectionFreeRun,
+}
 
 
 class Model:
-    def __init__(self, number_of_particles, temperature, stop_condition):
+    def __init__(
+        self,
+        number_of_particles,
+        temperature,
+        stop_condition,
+        verify_energy=False,
+        engine="scalar",
+        convergence="batch_means",
+        checkpoint_path=None,
+        resume=False,
+        checkpoint_interval=constants.CHECKPOINT_INTERVAL,
+        track_levels=False,
+        seed=None,
+        track_heat_capacity=False,
+    ):
         self.number_of_particles = number_of_particles
         self.max_energy_level = constants.MAX_ENERGY_LEVEL
         self.temperature = temperature
         self.stop_condition = stop_condition
-        self.mu = calculations.find_mu(
-            temperature=temperature, number_of_particles=number_of_particles
-        )
+        self.verify_energy = verify_energy
+        self.engine = engine
+        self.convergence = convergence
+        self.checkpoint_path = checkpoint_path
+        self.resume = resume
+        self.checkpoint_interval = checkpoint_interval
+        self.track_levels = track_levels
+        self.track_heat_capacity = track_heat_capacity
+        self.seed = seed
+        self.seed_sequence = get_seed_sequence(seed, number_of_particles, temperature)
+        self._last_checkpoint_time = time.monotonic()
+        self.metrics = instrumentation.Metrics()
+        with self.metrics.time("find_mu"):
+            self.mu = calculations.find_mu(
+                temperature=temperature, number_of_particles=number_of_particles
+            )
         logging.info(f"mu: {self.mu}")
 
     def run(self) -> Run:
-        steps = int(self.number_of_particles * 1e2 // 2)
-        half_attempt = Run(
-            temperature=self.temperature,
-            max_energy_level=self.max_energy_level,
-            number_of_particles=self.number_of_particles,
-            mu=self.mu,
-        )
-        full_attempt = Run(
-            temperature=self.temperature,
-            max_energy_level=self.max_energy_level,
-            number_of_particles=self.number_of_particles,
-            mu=self.mu,
-        )
-        while not self._should_stop(half_attempt, full_attempt):
-            steps *= 2
-            if steps > constants.MAX_STEPS:
-                logging.info(f"Max steps reached: {steps}")
-                return full_attempt
-
-            logging.info(f"Running {steps:.0e} steps (Temperature: {self.temperature})")
-            half_attempt.copy(full_attempt)
-            half_attempt = self._run_attempt(half_attempt, steps // 2)
-            full_attempt.copy(half_attempt)
-            full_attempt = self._run_attempt(full_attempt, steps // 2)
+        if self.convergence == "batch_means":
+            result = self._run_batch_means()
+        else:
+            result = self._run_doubling()
+        self.metrics.count("top_energy_level", result.particles.top_energy_level)
+        if self.metrics.counters["ceiling_hits"]:
+            logging.warning(
+                f"Particles reached the highest energy level {self.max_energy_level} "
+                f"{self.metrics.counters['ceiling_hits']} times, the results are "
+                f"clipped by it (Temperature: {self.temperature})"
+            )
+        return result
+
+    def _run_batch_means(self) -> Run:
+        # A single chain, stopped once the batch-means standard error of the ground
+        # state mean is below stop_condition relative to the mean
+        state = self._load_checkpoint()
+        if state is not None:
+            attempt = state["attempt"]
+        else:
+            attempt = self._create_run()
+            # Batches start at one sweep and grow by merging pairs, so the test
+            # can stop as soon as the chain allows instead of after 32 long batches
+            attempt.convergence = convergence.BatchMeans(
+                batch_size=max(1, int(self.number_of_particles))
+            )
+            if self.track_heat_capacity:
+                attempt.heat_capacity_convergence = convergence.BatchCovariance(
+                    batch_size=attempt.convergence.batch_size
+                )
+            # Batches of the level occupancies, for the errors of reweighting
+            if self.track_levels:
+                attempt.level_convergence = convergence.BatchArrays(
+                    batch_size=attempt.convergence.batch_size,
+                    size=self.max_energy_level + 1,
+                )
+        ground_level = attempt.data.ground_level
+        data = attempt.data
+        while not attempt.convergence.has_converged(self.stop_condition):
+            if attempt.data.steps >= constants.MAX_STEPS:
+                logging.info(f"Max steps reached: {attempt.data.steps}")
+                break
+
+            batch_size = attempt.convergence.batch_size
+            previous_sum, previous_square_sum = ground_level.sum, ground_level.square_sum
+            previous_energy_sums = (
+                data.total_energy_sum,
+                data.score_sum,
+                data.energy_score_sum,
+            )
+            if data.levels is not None:
+                previous_level_sums = data.levels.means * data.levels.count
+            self._run_steps(attempt, batch_size)
+            self.metrics.count("batches")
+            attempt.convergence.add_batch(
+                ground_level.sum - previous_sum,
+                ground_level.square_sum - previous_square_sum,
+                batch_size,
+            )
+            if attempt.heat_capacity_convergence is not None:
+                attempt.heat_capacity_convergence.add_batch(
+                    data.total_energy_sum - previous_energy_sums[0],
+                    data.score_sum - previous_energy_sums[1],
+                    data.energy_score_sum - previous_energy_sums[2],
+                    batch_size,
+                )
+            if attempt.level_convergence is not None:
+                attempt.level_convergence.add_batch(
+                    data.levels.means * data.levels.count - previous_level_sums,
+                    batch_size,
+                )
+            if attempt.convergence.batch_size != batch_size:
+                self.metrics.count("stages")
+                logging.info(
+                    f"Batch size: {batch_size:.0e}, steps: {attempt.data.steps:.1e}, "
+                    f"standard error: {attempt.convergence.standard_error:.2e} "
+                    f"(Temperature: {self.temperature})"
+                )
+            self._save_checkpoint({"attempt": attempt})
+
+        self._save_checkpoint({"attempt": attempt}, force=True)
+        return attempt
+
+    def _run_doubling(self) -> Run:
+        # Every stage first continues the full attempt into the half attempt for
+        # steps // 2 steps, then continues that into the full attempt for another
+        # steps // 2 steps. phase and done_steps record where inside a stage we are,
+        # so a checkpoint can be resumed in the middle of an attempt.
+        state = self._load_checkpoint()
+        if state is not None:
+            steps, phase, done_steps = state["steps"], state["phase"], state["done_steps"]
+            half_attempt, full_attempt = state["half_attempt"], state["full_attempt"]
+        else:
+            steps, phase, done_steps = int(self.number_of_particles * 1e2 // 2), None, 0
+            # The half attempt starts every stage as a copy of the full attempt,
+            # so only the full attempt is burned in
+            half_attempt = self._create_run(burn_in=False)
+            full_attempt = self._create_run()
+
+        def save_checkpoint(done_steps, force=False):
+            self._save_checkpoint(
+                {
+                    "steps": steps,
+                    "phase": phase,
+                    "done_steps": done_steps,
+                    "half_attempt": half_attempt,
+                    "full_attempt": full_attempt,
+                },
+                force=force,
+            )
+
+        while True:
+            if phase is None:
+                if self._should_stop(half_attempt, full_attempt):
+                    break
+                steps *= 2
+                if steps > constants.MAX_STEPS:
+                    logging.info(f"Max steps reached: {steps}")
+                    steps //= 2
+                    break
 
+                logging.info(
+                    f"Running {steps:.0e} steps (Temperature: {self.temperature})"
+                )
+                self.metrics.count("stages")
+                half_attempt.copy(full_attempt)
+                phase, done_steps = "half", 0
+
+            if phase == "half":
+                self._run_attempt(half_attempt, steps // 2, done_steps, save_checkpoint)
+                full_attempt.copy(half_attempt)
+                phase, done_steps = "full", 0
+
+            self._run_attempt(full_attempt, steps // 2, done_steps, save_checkpoint)
+            phase, done_steps = None, 0
+
+        save_checkpoint(done_steps, force=True)
         return full_attempt
 
-    def _run_attempt(self, attempt, steps) -> Run:
-        for i in range(steps):
-            if i % int(round(2 * steps // 5)) == 0:
+    def _create_run(self, burn_in=True) -> Run:
+        with self.metrics.time("table_setup"):
+            run = ENGINES[self.engine](
+                temperature=self.temperature,
+                max_energy_level=self.max_energy_level,
+                number_of_particles=self.number_of_particles,
+                mu=self.mu,
+                verify_energy=self.verify_energy,
+                track_levels=self.track_levels,
+                rng=np.random.default_rng(self.seed_sequence.spawn(1)[0]),
+                track_heat_capacity=self.track_heat_capacity,
+                top_energy_level=calculations.get_top_energy_level(
+                    self.mu,
+                    self.temperature,
+                    self.number_of_particles,
+                    self.max_energy_level,
+                ),
+            )
+        if burn_in and self.track_heat_capacity:
+            self._burn_in(run)
+        return run
+
+    def _burn_in(self, run):
+        # The relaxation from the random initial state dominates fluctuation
+        # estimates, so the chain first runs until the mean energy of consecutive
+        # sweeps stops drifting in its initial direction, then starts measuring
+        sweep_steps = max(1, int(self.number_of_particles * constants.BURN_IN_SWEEPS))
+        previous_energy, direction = None, 0
+        while run.data.steps < constants.MAX_STEPS:
+            energy_sum = run.data.total_energy_sum
+            self._run_steps(run, sweep_steps)
+            energy = (run.data.total_energy_sum - energy_sum) / sweep_steps
+            if previous_energy is not None:
+                change = np.sign(energy - previous_energy)
+                if direction == 0:
+                    direction = change
+                elif change != direction:
+                    break
+            previous_energy = energy
+        self.metrics.count("burn_in_steps", run.data.steps)
+        run.reset_data()
+
+    def _run_attempt(self, attempt, steps, done_steps=0, save_checkpoint=None) -> Run:
+        log_interval = max(1, int(round(2 * steps // 5)))
+        chunk_size = min(log_interval, constants.CHECKPOINT_STEPS)
+        for i in range(done_steps, steps, chunk_size):
+            if i % log_interval < chunk_size:
                 logging.info(
                     f"Currently in Step: {i:.1e} / {steps:.1e}, (Temperature={self.temperature})"
                 )
-
-            attempt.run_step()
+            self._run_steps(attempt, min(chunk_size, steps - i))
+            if save_checkpoint is not None:
+                save_checkpoint(min(i + chunk_size, steps))
 
         return attempt
 
+    def _run_steps(self, attempt, steps):
+        null_moves = getattr(attempt, "null_moves", 0)
+        ceiling_hits = attempt.particles.ceiling_hits
+        with self.metrics.time("stepping"):
+            attempt.run_steps(steps)
+        self.metrics.count("steps", steps)
+        self.metrics.count("null_moves", getattr(attempt, "null_moves", 0) - null_moves)
+        self.metrics.count("ceiling_hits", attempt.particles.ceiling_hits - ceiling_hits)
+
+    def _load_checkpoint(self):
+        if self.checkpoint_path is None or not self.resume:
+            return None
+
+        state = checkpoint.load(self.checkpoint_path)
+        if state is None:
+            return None
+        model_parameters = self._get_checkpoint_parameters()
+        if state["model"] != model_parameters:
+            raise ValueError(
+                f"Checkpoint {self.checkpoint_path} was written for {state['model']}, "
+                f"not {model_parameters}"
+            )
+        logging.info(f"Resuming from {self.checkpoint_path}")
+        return state
+
+    def _save_checkpoint(self, state, force=False):
+        if self.checkpoint_path is None:
+            return
+        if (
+            not force
+            and time.monotonic() - self._last_checkpoint_time < self.checkpoint_interval
+        ):
+            return
+
+        checkpoint.save(
+            self.checkpoint_path, {"model": self._get_checkpoint_parameters(), **state}
+        )
+        self._last_checkpoint_time = time.monotonic()
+
+    def _get_checkpoint_parameters(self):
+        return {
+            "number_of_particles": self.number_of_particles,
+            "temperature": self.temperature,
+            "stop_condition": self.stop_condition,
+            "engine": self.engine,
+            "convergence": self.convergence,
+            "track_levels": self.track_levels,
+            "track_heat_capacity": self.track_heat_capacity,
+            "seed": self.seed,
+        }
+
     def _should_stop(self, half_attempt, full_attempt) -> bool:
         if half_attempt.data.steps == 0 or full_attempt.data.steps == 0:
             return False
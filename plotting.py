@@ -0,0 +1,266 @@
+import multiprocessing
+import pathlib
+
+import matplotlib
+from matplotlib import pyplot as plt
+import numpy as np
+
+import calculations
+
+# update matplotlib params:
+# plt.rcParams.update({"text.usetex": True})
+plt.rcParams.update({"font.size": 16})
+
+
+def plot_data(data):
+    for plot_figure in FIGURES.values():
+        plot_figure(data)
+        plt.show()
+
+
+def save_figures(data, directory, processes=None, extension="png"):
+    # Every figure is rendered by its own process with the non-interactive Agg
+    # backend, so no display is needed. By default all figures render at once.
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    if processes is None:
+        processes = len(FIGURES)
+    with multiprocessing.Pool(
+        processes=min(processes, len(FIGURES)),
+        initializer=matplotlib.use,
+        initargs=["Agg"],
+    ) as pool:
+        return pool.starmap(
+            _save_figure,
+            [(name, data, directory / f"{name}.{extension}") for name in FIGURES],
+        )
+
+
+def _save_figure(name, data, path):
+    FIGURES[name](data)
+    plt.savefig(path)
+    plt.close("all")
+    return path
+
+
+def _plot_heat_capacities(data):
+    if len(data) == 4:
+        fig, axs = plt.subplots(2, 2, figsize=(12, 12))
+        fig.tight_layout(pad=3.0)
+    else:
+        axs = None
+    for i, (number_of_particles, number_of_particles_data) in enumerate(data.items()):
+        critical_temperature = calculations.get_critical_temperature(
+            temperature_range=number_of_particles_data["temperatures"],
+            ground_state_expected_values=number_of_particles_data[
+                "ground_state_expected_values"
+            ],
+            number_of_particles=int(number_of_particles),
+        )
+        plot_specific_heat_capacity(
+            total_energies=number_of_particles_data["total_energy_expected_values"],
+            temperatures=number_of_particles_data["temperatures"],
+            number_of_particles=int(number_of_particles),
+            critical_temperature=critical_temperature,
+            ax=None if axs is None else axs.flatten()[i],
+            heat_capacities=number_of_particles_data.get("heat_capacities"),
+            heat_capacity_errors=number_of_particles_data.get("heat_capacity_errors"),
+        )
+
+
+def _plot_ground_states_with_no_stds(data):
+    if len(data) == 4:
+        fig, axs = plt.subplots(2, 2, figsize=(12, 12))
+        fig.tight_layout(pad=3.0)
+    else:
+        axs = None
+
+    for i, (number_of_particles, number_of_particles_data) in enumerate(data.items()):
+        # create 4 subplots
+        plot_ground_state_expected_value(
+            temperature_range=number_of_particles_data["temperatures"],
+            ground_state_expected_values=number_of_particles_data[
+                "ground_state_expected_values"
+            ],
+            ground_state_stds=number_of_particles_data["ground_state_stds"],
+            number_of_particles=int(float(number_of_particles)),
+            ax=None if axs is None else axs.flatten()[i],
+            add_errorbar=False,
+            reweighted_temperatures=number_of_particles_data.get(
+                "reweighted_temperatures"
+            ),
+            reweighted_ground_state_expected_values=number_of_particles_data.get(
+                "reweighted_ground_state_expected_values"
+            ),
+            reweighted_ground_state_errors=number_of_particles_data.get(
+                "reweighted_ground_state_expected_value_errors"
+            ),
+        )
+
+
+def _plot_ground_states_with_stds(data):
+    if len(data) == 4:
+        fig, axs = plt.subplots(2, 2, figsize=(12, 12))
+        fig.tight_layout(pad=3.0)
+    else:
+        axs = None
+
+    for i, (number_of_particles, number_of_particles_data) in enumerate(data.items()):
+        # create 4 subplots
+        plot_ground_state_expected_value(
+            temperature_range=number_of_particles_data["temperatures"],
+            ground_state_expected_values=number_of_particles_data[
+                "ground_state_expected_values"
+            ],
+            ground_state_stds=number_of_particles_data["ground_state_stds"],
+            number_of_particles=int(float(number_of_particles)),
+            ax=None if axs is None else axs.flatten()[i],
+            add_errorbar=True,
+            reweighted_temperatures=number_of_particles_data.get(
+                "reweighted_temperatures"
+            ),
+            reweighted_ground_state_expected_values=number_of_particles_data.get(
+                "reweighted_ground_state_expected_values"
+            ),
+            reweighted_ground_state_errors=number_of_particles_data.get(
+                "reweighted_ground_state_expected_value_errors"
+            ),
+        )
+
+
+def plot_ground_state_expected_value(
+    temperature_range,
+    ground_state_expected_values,
+    number_of_particles,
+    ground_state_stds,
+    add_errorbar=True,
+    ax=None,
+    reweighted_temperatures=None,
+    reweighted_ground_state_expected_values=None,
+    reweighted_ground_state_errors=None,
+):
+    if ax is None:
+        ax = plt.gca()
+
+    x = temperature_range
+    y = [
+        expected_value / number_of_particles
+        for expected_value in ground_state_expected_values
+    ]
+    if reweighted_temperatures is None:
+        ax.plot(x, y, label=f"number of particles: {number_of_particles}")
+    else:
+        # The simulated temperatures as points on the reweighted curve
+        ax.plot(x, y, "o", label=f"number of particles: {number_of_particles}")
+        reweighted_y = np.divide(
+            reweighted_ground_state_expected_values, number_of_particles
+        )
+        ax.plot(reweighted_temperatures, reweighted_y, label="reweighted")
+        if reweighted_ground_state_errors is not None and None not in (
+            reweighted_ground_state_errors
+        ):
+            reweighted_errors = np.divide(
+                reweighted_ground_state_errors, number_of_particles
+            )
+            ax.fill_between(
+                reweighted_temperatures,
+                reweighted_y - reweighted_errors,
+                reweighted_y + reweighted_errors,
+                alpha=0.3,
+            )
+    if add_errorbar:
+        ax.errorbar(
+            x,
+            y,
+            yerr=[
+                std / expected_value
+                for expected_value, std in zip(
+                    ground_state_expected_values, ground_state_stds
+                )
+            ],
+            fmt="none",
+            ecolor="black",
+            elinewidth=0.5,
+            capsize=2,
+        )
+    ax.set_xlabel("Temperature")
+    ax.set_ylabel("Ground state expected value")
+    ax.set_title(f"Number of particles: {number_of_particles}")
+
+
+def plot_specific_heat_capacity(
+    number_of_particles,
+    temperatures,
+    total_energies,
+    critical_temperature=None,
+    ax=None,
+    heat_capacities=None,
+    heat_capacity_errors=None,
+):
+    if ax is None:
+        ax = plt.gca()
+
+    if critical_temperature is not None:
+        ax.axvline(x=critical_temperature, color="red", linestyle="--")
+
+    if heat_capacities is None or None in heat_capacities:
+        # Runs without the fluctuation estimate fall back to finite differences
+        # of the mean energies of neighbouring temperatures
+        heat_capacities = calculations.get_specific_heat_capacities(
+            total_energies=total_energies, temperatures=temperatures,
+        )
+        ax.plot(temperatures[:-1], heat_capacities, "bo")
+    else:
+        ax.plot(temperatures, heat_capacities, "bo")
+        if heat_capacity_errors is not None and None not in heat_capacity_errors:
+            ax.errorbar(
+                temperatures,
+                heat_capacities,
+                yerr=heat_capacity_errors,
+                fmt="none",
+                ecolor="black",
+                elinewidth=0.5,
+                capsize=2,
+            )
+    ax.set_xlabel("Temperature")
+    ax.set_ylabel("Specific heat capacity")
+    ax.set_title(f"Number of particles: {number_of_particles}")
+
+def plot_critical_temperature(data):
+    critical_temperatures = []
+    for number_of_particles, number_of_particles_data in data.items():
+        critical_temperatures.append(
+            calculations.get_critical_temperature(
+                temperature_range=number_of_particles_data["temperatures"],
+                ground_state_expected_values=number_of_particles_data[
+                    "ground_state_expected_values"
+                ],
+                number_of_particles=int(number_of_particles),
+            )
+        )
+    print(critical_temperatures)
+    # Grids that never reach the transition have no critical temperature
+    found = [
+        (int(number_of_particles), critical_temperature)
+        for number_of_particles, critical_temperature in zip(
+            data.keys(), critical_temperatures
+        )
+        if critical_temperature is not None
+    ]
+    numbers_of_particles = [number_of_particles for number_of_particles, _ in found]
+    critical_temperatures = [critical_temperature for _, critical_temperature in found]
+    plt.plot(numbers_of_particles, critical_temperatures)
+    plt.xlabel("Number of particles")
+    plt.ylabel("Critical temperature")
+    if found:
+        plt.loglog()
+    plt.grid()
+    plt.title("Critical temperature (log-log scale)")
+
+
+FIGURES = {
+    "ground_states_with_stds": _plot_ground_states_with_stds,
+    "ground_states_with_no_stds": _plot_ground_states_with_no_stds,
+    "critical_temperature": plot_critical_temperature,
+    "heat_capacities": _plot_heat_capacities,
+}
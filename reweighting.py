@@ -0,0 +1,160 @@
+import dataclasses
+
+import numpy as np
+
+import calculations
+import constants
+
+
+@dataclasses.dataclass
+class Histogram:
+    # Time averaged occupancy of every energy level over one run. Particles move
+    # independently of each other, so the occupancies are a sufficient statistic
+    # of the chain; a joint histogram of (E, N0) would not be.
+    temperature: float
+    mu: float
+    number_of_particles: float
+    steps: int
+    occupancies: np.ndarray
+    batch_occupancies: np.ndarray = None
+
+    @classmethod
+    def from_result(cls, result):
+        # A row of store.ResultStore written by a run that tracked levels
+        batch_occupancies = result.get("level_batch_means")
+        return cls(
+            temperature=result["temperature"],
+            mu=result["mu"],
+            number_of_particles=result["number_of_particles"],
+            steps=result["steps"],
+            occupancies=np.asarray(result["occupancy_expected_values"]),
+            batch_occupancies=None
+            if batch_occupancies is None
+            else np.asarray(batch_occupancies),
+        )
+
+    @property
+    def log_weights(self):
+        return calculations.get_stationary_log_probabilities(
+            self.mu, self.temperature, len(self.occupancies) - 1
+        )
+
+    @property
+    def jackknife_occupancies(self):
+        # Row j leaves batch j out
+        if self.batch_occupancies is None or len(self.batch_occupancies) < 2:
+            return None
+        batches = len(self.batch_occupancies)
+        return (self.batch_occupancies.sum(axis=0) - self.batch_occupancies) / (
+            batches - 1
+        )
+
+
+class Reweighting:
+    # Ferrenberg-Swendsen multi-histogram estimate of the single particle density
+    # of states from runs at several (T, mu). Every particle at every step is one
+    # sample of its level, drawn from that run's stationary weights. The density
+    # does not depend on the target, so it is solved once, together with one
+    # replicate per left out batch of every run for the errors.
+    def __init__(self, histograms, tolerance=1e-10, max_iterations=10 ** 4):
+        self.histograms = list(histograms)
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.number_of_particles = self.histograms[0].number_of_particles
+        self.log_weights = np.array(
+            [histogram.log_weights for histogram in self.histograms]
+        )
+        self.log_density = self._get_log_density(
+            [histogram.occupancies for histogram in self.histograms],
+            [histogram.steps for histogram in self.histograms],
+        )
+
+        # Replicates of the density, grouped by the run whose batch was left out
+        self.jackknife_log_densities = []
+        for index, histogram in enumerate(self.histograms):
+            jackknife_occupancies = histogram.jackknife_occupancies
+            if jackknife_occupancies is None:
+                self.jackknife_log_densities = None
+                break
+            batches = len(jackknife_occupancies)
+            steps = [other.steps for other in self.histograms]
+            steps[index] = histogram.steps * (batches - 1) / batches
+            occupancies = [other.occupancies for other in self.histograms]
+            group = []
+            for batch_occupancies in jackknife_occupancies:
+                occupancies[index] = batch_occupancies
+                group.append(self._get_log_density(occupancies, steps))
+            self.jackknife_log_densities.append(np.array(group))
+
+    def _get_log_density(self, occupancies, steps):
+        counts = np.array(steps, dtype=np.float64)[:, None] * np.array(occupancies)
+        samples = np.log(counts.sum(axis=1))[:, None]
+        level_counts = counts.sum(axis=0)
+        log_counts = np.full(len(level_counts), -np.inf)
+        np.log(level_counts, out=log_counts, where=level_counts > 0)
+        free_energies = np.zeros(len(counts))
+        for _ in range(self.max_iterations):
+            log_density = log_counts - np.logaddexp.reduce(
+                samples + self.log_weights - free_energies[:, None], axis=0
+            )
+            new_free_energies = np.logaddexp.reduce(
+                log_density + self.log_weights, axis=1
+            )
+            new_free_energies -= new_free_energies[0]
+            change = np.max(np.abs(new_free_energies - free_energies))
+            free_energies = new_free_energies
+            if change < self.tolerance:
+                break
+        return log_density - np.logaddexp.reduce(log_density)
+
+    def get_observables(self, temperature, mu=None):
+        # Expected values and fluctuations of the ground state occupancy and the
+        # total energy at (temperature, mu); mu defaults to the one that keeps the
+        # number of particles
+        if mu is None:
+            mu = calculations.find_mu(temperature, self.number_of_particles)
+        log_weights = calculations.get_stationary_log_probabilities(
+            mu, temperature, self.log_weights.shape[1] - 1
+        )
+        observables = _get_observables(
+            self.log_density, log_weights, self.number_of_particles
+        )
+        errors = {name: None for name in observables}
+        if self.jackknife_log_densities is not None:
+            variances = 0
+            for group in self.jackknife_log_densities:
+                estimates = _get_observables(group, log_weights, self.number_of_particles)
+                batches = len(group)
+                variances += np.array(
+                    [
+                        (batches - 1) * np.var(estimates[name])
+                        for name in observables
+                    ]
+                )
+            errors = dict(zip(observables, np.sqrt(variances).tolist()))
+        return {
+            **{name: float(value) for name, value in observables.items()},
+            **{f"{name}_error": error for name, error in errors.items()},
+        }
+
+
+def reweight(histograms, temperatures, mu=None):
+    # A single histogram is the one run case of the multi-histogram estimate
+    reweighting = Reweighting(histograms)
+    return [
+        reweighting.get_observables(temperature, mu=mu) for temperature in temperatures
+    ]
+
+
+def get_curve_temperatures(histograms, points=constants.REWEIGHTING_POINTS):
+    temperatures = [histogram.temperature for histogram in histograms]
+    return np.linspace(min(temperatures), max(temperatures), points).tolist()
+
+
+def _get_observables(log_density, log_weights, number_of_particles):
+    log_probabilities = log_density + log_weights
+    return calculations.get_independent_particle_observables(
+        log_probabilities
+        - np.logaddexp.reduce(log_probabilities, axis=-1, keepdims=True),
+        number_of_particles,
+    )
@@ -1,153 +1,574 @@
+import cProfile
+import checkpoint
+import instrumentation
 import model
-from matplotlib import pyplot as plt
+import ensemble
+import exact
+import reweighting
+import tempering
+import work_queue
+import store
 import numpy as np
 import calculations
+import constants
 import click
 import logging
 import json
 import multiprocessing
+import bisect
+import contextlib
 import signal
 import os
 import pathlib
+import pickle
+import secrets
+import time
 
 logging.getLogger().setLevel(logging.INFO)
 
-# update matplotlib params:
-# plt.rcParams.update({"text.usetex": True})
-plt.rcParams.update({"font.size": 16})
+# Options of main that describe a sweep to simulate
+SWEEP_OPTIONS = [
+    "particles",
+    "fast",
+    "adaptive",
+    "engine",
+    "use_ensemble",
+    "replicas",
+    "use_tempering",
+    "use_exact",
+    "queue",
+    "convergence",
+    "resume",
+    "track_levels",
+    "heat_capacity",
+    "profile",
+    "seed",
+]
 
 
 @click.command()
 @click.argument("path", type=click.Path(exists=False))
 @click.option("--particles", type=int, default=None)
 @click.option("--plot", is_flag=True, default=False)
+@click.option("--figures", type=click.Path(file_okay=False), default=None)
 @click.option("--fast", is_flag=True, default=False)
-@click.option("--processes", "-p", type=int, default=1)
-def main(path, particles, plot, fast, processes):
-    if not plot:
+@click.option("--adaptive", is_flag=True, default=False)
+@click.option("--processes", "-p", type=int, default=None)
+@click.option(
+    "--engine", type=click.Choice(list(model.ENGINES)), default="scalar",
+)
+@click.option(
+    "--ensemble",
+    "use_ensemble",
+    is_flag=True,
+    default=False,
+    help="Advance all chains of a number of particles in vectorized lock-step. "
+    f"Below {constants.ENSEMBLE_MIN_CHAINS} chains (temperatures times replicas) "
+    "the chains run one by one as "
+    "block engine runs, which is faster there, so the default grid of 10 "
+    "particles only runs in lock-step with --replicas 2 or more.",
+)
+@click.option("--replicas", type=int, default=1)
+@click.option("--tempering", "use_tempering", is_flag=True, default=False)
+@click.option("--exact", "use_exact", is_flag=True, default=False)
+@click.option("--queue", type=click.Path(file_okay=False), default=None)
+@click.option("--worker", is_flag=True, default=False)
+@click.option(
+    "--convergence",
+    type=click.Choice(["batch_means", "doubling"]),
+    default="batch_means",
+)
+@click.option("--resume", is_flag=True, default=False)
+@click.option("--mu-cache", type=click.Path(), default=None)
+@click.option("--track-levels", is_flag=True, default=False)
+@click.option("--reweight", is_flag=True, default=False)
+@click.option("--heat-capacity/--no-heat-capacity", default=True)
+@click.option("--profile", is_flag=True, default=False)
+@click.option("--seed", type=int, default=None)
+def main(
+    path,
+    particles,
+    plot,
+    figures,
+    fast,
+    adaptive,
+    processes,
+    engine,
+    use_ensemble,
+    replicas,
+    use_tempering,
+    use_exact,
+    queue,
+    worker,
+    convergence,
+    resume,
+    mu_cache,
+    track_levels,
+    reweight,
+    heat_capacity,
+    profile,
+    seed,
+):
+    # Reweighted curves are built from the level occupancies of every run
+    track_levels = track_levels or reweight
+    # Figures are rendered in parallel unless -p says otherwise, the simulation
+    # runs in one process
+    figure_processes = processes
+    processes = 1 if processes is None else processes
+    if mu_cache is not None:
+        calculations.load_mu_cache(mu_cache)
+    if worker:
+        # PATH is the queue directory of a sweep started with --queue
+        run_queue_workers(path, processes=processes)
+    elif not plot and (figures is None or _has_sweep_options()):
+        # --figures on its own renders the results already in PATH
         if particles is None:
-            run_multiple_models(path, fast=fast, processes=processes)
+            run_multiple_models(
+                path,
+                fast=fast,
+                adaptive=adaptive,
+                processes=processes,
+                engine=engine,
+                use_ensemble=use_ensemble,
+                replicas=replicas,
+                use_tempering=use_tempering,
+                use_exact=use_exact,
+                queue=queue,
+                convergence=convergence,
+                resume=resume,
+                track_levels=track_levels,
+                track_heat_capacity=heat_capacity,
+                profile=profile,
+                seed=seed,
+            )
         else:
             run_multiple_models(
-                path, numbers_of_particles=[particles], fast=fast, processes=processes
+                path,
+                numbers_of_particles=[particles],
+                fast=fast,
+                adaptive=adaptive,
+                processes=processes,
+                engine=engine,
+                use_ensemble=use_ensemble,
+                replicas=replicas,
+                use_tempering=use_tempering,
+                use_exact=use_exact,
+                queue=queue,
+                convergence=convergence,
+                resume=resume,
+                track_levels=track_levels,
+                track_heat_capacity=heat_capacity,
+                profile=profile,
+                seed=seed,
             )
-    else:
-        with open(path, "rt") as file:
-            data = json.load(file)
-        plot_data(data)
-
-
-def plot_data(data):
-    _plot_ground_states_with_stds(data)
-    _plot_ground_states_with_no_stds(data)
-    plot_critical_temperature(data)
-    _plot_heat_capacities(data)
-
-
-def _plot_heat_capacities(data):
-    if len(data) == 4:
-        fig, axs = plt.subplots(2, 2, figsize=(12, 12))
-        fig.tight_layout(pad=3.0)
-    else:
-        axs = None
-    for i, (number_of_particles, number_of_particles_data) in enumerate(data.items()):
-        critical_temperature = calculations.get_critical_temperature(
-            temperature_range=number_of_particles_data["temperatures"],
-            ground_state_expected_values=number_of_particles_data[
-                "ground_state_expected_values"
-            ],
-            number_of_particles=int(number_of_particles),
-        )
-        plot_specific_heat_capacity(
-            total_energies=number_of_particles_data["total_energy_expected_values"],
-            temperatures=number_of_particles_data["temperatures"],
-            number_of_particles=int(number_of_particles),
-            critical_temperature=critical_temperature,
-            ax=None if axs is None else axs.flatten()[i],
-        )
-    plt.show()
-
+    if plot or figures is not None:
+        # Plotting pulls in matplotlib, which the simulation and its pool workers
+        # never need
+        import plotting
 
-def _plot_ground_states_with_no_stds(data):
-    if len(data) == 4:
-        fig, axs = plt.subplots(2, 2, figsize=(12, 12))
-        fig.tight_layout(pad=3.0)
-    else:
-        axs = None
-
-    for i, (number_of_particles, number_of_particles_data) in enumerate(data.items()):
-        # create 4 subplots
-        plot_ground_state_expected_value(
-            temperature_range=number_of_particles_data["temperatures"],
-            ground_state_expected_values=number_of_particles_data[
-                "ground_state_expected_values"
-            ],
-            ground_state_stds=number_of_particles_data["ground_state_stds"],
-            number_of_particles=int(float(number_of_particles)),
-            ax=None if axs is None else axs.flatten()[i],
-            add_errorbar=False,
-        )
-    plt.show()
+        data = _read_data(path)
+        if reweight:
+            _add_reweighted_curves(data, _get_store_path(path))
+        if figures is None:
+            plotting.plot_data(data)
+        else:
+            plotting.save_figures(data, figures, processes=figure_processes)
+    if mu_cache is not None:
+        calculations.save_mu_cache(mu_cache)
 
 
-def _plot_ground_states_with_stds(data):
-    if len(data) == 4:
-        fig, axs = plt.subplots(2, 2, figsize=(12, 12))
-        fig.tight_layout(pad=3.0)
-    else:
-        axs = None
-
-    for i, (number_of_particles, number_of_particles_data) in enumerate(data.items()):
-        # create 4 subplots
-        plot_ground_state_expected_value(
-            temperature_range=number_of_particles_data["temperatures"],
-            ground_state_expected_values=number_of_particles_data[
-                "ground_state_expected_values"
-            ],
-            ground_state_stds=number_of_particles_data["ground_state_stds"],
-            number_of_particles=int(float(number_of_particles)),
-            ax=None if axs is None else axs.flatten()[i],
-            add_errorbar=True,
-        )
-    plt.show()
+def _has_sweep_options():
+    context = click.get_current_context()
+    return any(
+        context.get_parameter_source(name) != click.core.ParameterSource.DEFAULT
+        for name in SWEEP_OPTIONS
+    )
 
 
-def run_multiple_models(path, numbers_of_particles=None, fast=False, processes=1):
+def run_multiple_models(
+    path,
+    numbers_of_particles=None,
+    fast=False,
+    adaptive=False,
+    processes=1,
+    engine="scalar",
+    use_ensemble=False,
+    replicas=1,
+    use_tempering=False,
+    use_exact=False,
+    queue=None,
+    convergence="batch_means",
+    resume=False,
+    track_levels=False,
+    track_heat_capacity=True,
+    profile=False,
+    seed=None,
+):
     if numbers_of_particles is None:
         numbers_of_particles = [1e1, 1e2, 1e3, 1e4]
+    if seed is None and resume:
+        seed = _get_resume_seed(path)
+    if seed is None:
+        seed = secrets.randbits(63)
+    logging.info(f"Seed: {seed}")
+    if adaptive and (use_ensemble or use_tempering or use_exact or queue):
+        raise click.UsageError(
+            "--adaptive schedules single temperatures, it cannot be combined with "
+            "--ensemble, --tempering, --exact or --queue"
+        )
 
+    sweep_start_time = time.monotonic()
+    number_of_particles_to_temperatures = {}
     number_of_particles_to_data = {}
+    warmup_start_time = time.monotonic()
     for number_of_particles in numbers_of_particles:
-        logging.info(f"Number of particles: {number_of_particles}")
         if fast:
             temperatures = [0.2, 1]
+        elif adaptive:
+            temperatures = _get_adaptive_temperatures(number_of_particles)
         else:
             temperatures = _get_temperatures(number_of_particles, step_side=0.2)
-        (
-            ground_state_expected_values,
-            ground_state_stds,
-            total_energy,
-            total_energy_stds,
-        ) = multiple_temperature_runs(
-            number_of_particles, temperatures, processes, path
+        number_of_particles_to_temperatures[number_of_particles] = temperatures
+        number_of_particles_to_data[number_of_particles] = {
+            "temperatures": [],
+            "ground_state_expected_values": [],
+            "ground_state_stds": [],
+            "total_energy_expected_values": [],
+            "total_energy_stds": [],
+            "heat_capacities": [],
+            "heat_capacity_errors": [],
+        }
+        _warm_caches(number_of_particles, temperatures)
+    warmup_time = time.monotonic() - warmup_start_time
+
+    if use_exact:
+        # The stationary law of the chain is known in closed form, there is
+        # nothing to sample
+        for number_of_particles, temperatures in number_of_particles_to_temperatures.items():
+            start_time = time.monotonic()
+            values = exact_temperature_runs(number_of_particles, temperatures, path)
+            instrumentation.write_records(
+                _get_metrics_path(path),
+                [
+                    {
+                        "record": "job",
+                        "number_of_particles": number_of_particles,
+                        "temperatures": temperatures,
+                        "engine": "exact",
+                        "pid": os.getpid(),
+                        "wall_time": time.monotonic() - start_time,
+                    }
+                ],
+            )
+            for temperature, temperature_values in zip(temperatures, values):
+                _add_values(
+                    number_of_particles_to_data,
+                    number_of_particles,
+                    temperature,
+                    temperature_values,
+                )
+            _finish_number_of_particles(number_of_particles_to_data, number_of_particles)
+        _write_data(path, number_of_particles_to_data)
+        return
+
+    if queue is not None:
+        coordinate_queue(
+            path,
+            queue,
+            number_of_particles_to_temperatures,
+            number_of_particles_to_data,
+            engine=engine,
+            convergence=convergence,
+            track_levels=track_levels,
+            track_heat_capacity=track_heat_capacity,
+            seed=seed,
+        )
+        return
+
+    if use_ensemble or use_tempering:
+        for number_of_particles, temperatures in number_of_particles_to_temperatures.items():
+            logging.info(f"Number of particles: {number_of_particles}")
+            start_time = time.monotonic()
+            if use_ensemble:
+                results = ensemble_temperature_runs(
+                    number_of_particles, temperatures, path, replicas=replicas, seed=seed
+                )
+            else:
+                results = tempering_temperature_runs(
+                    number_of_particles, temperatures, path, engine=engine, seed=seed
+                )
+            instrumentation.write_records(
+                _get_metrics_path(path),
+                [
+                    {
+                        "record": "job",
+                        "number_of_particles": number_of_particles,
+                        "temperatures": temperatures,
+                        "engine": "ensemble" if use_ensemble else f"tempering-{engine}",
+                        "pid": os.getpid(),
+                        "wall_time": time.monotonic() - start_time,
+                        "steps": sum(data.steps for data in results),
+                    }
+                ],
+            )
+            for temperature, data in zip(temperatures, results):
+                _add_result(
+                    number_of_particles_to_data, number_of_particles, temperature, data
+                )
+            _finish_number_of_particles(number_of_particles_to_data, number_of_particles)
+        _write_data(path, number_of_particles_to_data)
+        return
+
+    # Without --adaptive there is a single round over the whole grid. With it,
+    # every round adds the temperatures where the curves of the previous rounds
+    # are not resolved yet, until no interval needs splitting.
+    number_of_jobs = 0
+    busy_time = 0
+    pending_temperatures = number_of_particles_to_temperatures
+    while pending_temperatures:
+        jobs = sorted(
+            [
+                (number_of_particles, temperature)
+                for number_of_particles, temperatures in pending_temperatures.items()
+                for temperature in temperatures
+            ],
+            key=lambda job: _get_job_cost(*job),
+            reverse=True,
+        )
+        number_of_jobs += len(jobs)
+        for number_of_particles, temperature, data, extra, record in multiple_model_runs(
+            jobs,
+            processes,
+            path,
+            engine=engine,
+            convergence=convergence,
+            resume=resume,
+            track_levels=track_levels,
+            track_heat_capacity=track_heat_capacity,
+            profile=profile,
+            seed=seed,
+        ):
+            busy_time += record["wall_time"]
+            instrumentation.write_records(_get_metrics_path(path), [record])
+            _add_result(
+                number_of_particles_to_data,
+                number_of_particles,
+                temperature,
+                data,
+                heat_capacity_error=extra.get("heat_capacity_error"),
+            )
+            if len(
+                number_of_particles_to_data[number_of_particles]["temperatures"]
+            ) == len(number_of_particles_to_temperatures[number_of_particles]):
+                _finish_number_of_particles(
+                    number_of_particles_to_data, number_of_particles
+                )
+        if not adaptive:
+            break
+        pending_temperatures = _get_refinement_temperatures(
+            number_of_particles_to_data
         )
-        plot_ground_state_expected_value(
-            temperature_range=temperatures,
-            ground_state_expected_values=ground_state_expected_values,
+        for number_of_particles, temperatures in pending_temperatures.items():
+            logging.info(
+                f"Refining {number_of_particles} particles at temperatures {temperatures}"
+            )
+            number_of_particles_to_temperatures[number_of_particles] = sorted(
+                number_of_particles_to_temperatures[number_of_particles] + temperatures
+            )
+            _warm_caches(number_of_particles, temperatures)
+    # Every result is already in the store, the aggregate JSON is written once for
+    # the tools that read it
+    _write_data(path, number_of_particles_to_data)
+    sweep_time = time.monotonic() - sweep_start_time
+    instrumentation.write_records(
+        _get_metrics_path(path),
+        [
+            {
+                "record": "sweep",
+                "jobs": number_of_jobs,
+                "processes": processes,
+                "seed": seed,
+                "warmup_time": warmup_time,
+                "wall_time": sweep_time,
+                "busy_time": busy_time,
+                "worker_utilization": busy_time / (processes * sweep_time),
+            }
+        ],
+    )
+
+
+def _warm_caches(number_of_particles, temperatures):
+    # Solving the whole grid at once fills the mu and probability table caches,
+    # which the pool workers inherit, so no Model has to build them again
+    calculations.get_decrease_probability_tables(
+        calculations.find_mus(temperatures, number_of_particles), temperatures
+    )
+
+
+def _get_refinement_temperatures(number_of_particles_to_data):
+    number_of_particles_to_temperatures = {}
+    for number_of_particles, data in number_of_particles_to_data.items():
+        temperatures = calculations.get_refinement_temperatures(
+            temperatures=data["temperatures"],
+            ground_state_expected_values=data["ground_state_expected_values"],
             number_of_particles=number_of_particles,
-            ground_state_stds=ground_state_stds,
+            heat_capacities=data["heat_capacities"],
         )
-        number_of_particles_to_data[number_of_particles] = {
-            "temperatures": temperatures,
-            "ground_state_expected_values": ground_state_expected_values,
-            "ground_state_stds": ground_state_stds,
-            "total_energy_expected_values": total_energy,
-            "total_energy_stds": total_energy_stds,
-        }
-        with open(path, "wt") as file:
-            json.dump(
-                number_of_particles_to_data, file, indent=4,
+        if temperatures:
+            number_of_particles_to_temperatures[number_of_particles] = temperatures
+    return number_of_particles_to_temperatures
+
+
+def _add_result(
+    number_of_particles_to_data,
+    number_of_particles,
+    temperature,
+    data,
+    heat_capacity_error=None,
+):
+    _add_values(
+        number_of_particles_to_data,
+        number_of_particles,
+        temperature,
+        {
+            **_get_values(data),
+            "heat_capacity": data.heat_capacity,
+            "heat_capacity_error": heat_capacity_error,
+        },
+    )
+
+
+def _add_values(number_of_particles_to_data, number_of_particles, temperature, values):
+    # Results arrive in any order, the lists of every number of particles are kept
+    # sorted by temperature
+    number_of_particles_data = number_of_particles_to_data[number_of_particles]
+    index = bisect.bisect(number_of_particles_data["temperatures"], temperature)
+    for key, value in [
+        ("temperatures", temperature),
+        ("ground_state_expected_values", values["ground_state_expected_value"]),
+        ("ground_state_stds", values["ground_state_std"]),
+        ("total_energy_expected_values", values["total_energy_expected_value"]),
+        ("total_energy_stds", values["total_energy_std"]),
+        ("heat_capacities", values.get("heat_capacity")),
+        ("heat_capacity_errors", values.get("heat_capacity_error")),
+    ]:
+        number_of_particles_data[key].insert(index, value)
+
+
+def _finish_number_of_particles(number_of_particles_to_data, number_of_particles):
+    number_of_particles_data = number_of_particles_to_data[number_of_particles]
+    logging.info(
+        f"Finished number of particles: {number_of_particles} "
+        f"({len(number_of_particles_data['temperatures'])} temperatures)"
+    )
+
+
+def _read_data(path):
+    if pathlib.Path(path).suffix == ".sqlite":
+        with store.ResultStore(path) as result_store:
+            return result_store.to_plot_data()
+    with open(path, "rt") as file:
+        return json.load(file)
+
+
+def _add_reweighted_curves(data, store_path):
+    # Multi-histogram curves through all runs of every number of particles that
+    # recorded its level occupancies
+    if not pathlib.Path(store_path).exists():
+        return
+    # The aggregate JSON keeps the numbers of particles as given, "10.0" for the
+    # default sweep, while the store keys read "10"
+    number_of_particles_to_data = {float(key): value for key, value in data.items()}
+    with store.ResultStore(store_path) as result_store:
+        for number_of_particles in result_store.get_numbers_of_particles():
+            histograms = [
+                reweighting.Histogram.from_result(result)
+                for result in result_store.iter_results(number_of_particles)
+                if "mu" in result
+            ]
+            number_of_particles_data = number_of_particles_to_data.get(
+                float(number_of_particles)
             )
+            if not histograms or number_of_particles_data is None:
+                continue
+            temperatures = reweighting.get_curve_temperatures(histograms)
+            observables = reweighting.reweight(histograms, temperatures)
+            number_of_particles_data["reweighted_temperatures"] = temperatures
+            for name in [
+                "ground_state_expected_value",
+                "ground_state_expected_value_error",
+                "total_energy_expected_value",
+                "total_energy_expected_value_error",
+            ]:
+                number_of_particles_data[f"reweighted_{name}s"] = [
+                    values[name] for values in observables
+                ]
+
+
+def _write_data(path, number_of_particles_to_data):
+    with open(path, "wt") as file:
+        json.dump(
+            number_of_particles_to_data, file, indent=4,
+        )
+
+
+def _get_store_path(path):
+    return pathlib.Path(path).with_suffix(".sqlite")
+
+
+def _get_metrics_path(path):
+    return pathlib.Path(path).with_suffix(".metrics.jsonl")
+
+
+def _get_profile_path(path, number_of_particles, temperature):
+    return pathlib.Path(path).with_suffix(
+        f".{int(number_of_particles)}.{temperature}.prof"
+    )
+
+
+def _get_checkpoint_path(path, number_of_particles, temperature):
+    # Jobs of different particle counts run side by side, so both parameters are
+    # part of the file name
+    return pathlib.Path(path).with_suffix(
+        f".{int(number_of_particles)}.{temperature}.checkpoint"
+    )
+
+
+def _get_resume_seed(path):
+    # The seed is part of the identity of every checkpoint, so a sweep resumed
+    # without --seed has to continue with the one it was started with: that of
+    # the newest checkpoint, or else of the last record in the metrics file
+    path = pathlib.Path(path)
+    checkpoint_paths = sorted(
+        path.parent.glob(f"{path.stem}.*.checkpoint"),
+        key=lambda checkpoint_path: checkpoint_path.stat().st_mtime,
+        reverse=True,
+    )
+    for checkpoint_path in checkpoint_paths:
+        try:
+            state = checkpoint.load(checkpoint_path)
+        except (ValueError, OSError, EOFError, pickle.UnpicklingError):
+            continue
+        if state is not None and state["model"].get("seed") is not None:
+            logging.info(f"Resuming with the seed of {checkpoint_path}")
+            return state["model"]["seed"]
+
+    seed = None
+    metrics_path = _get_metrics_path(path)
+    if metrics_path.exists():
+        with metrics_path.open("rt") as file:
+            for line in file:
+                with contextlib.suppress(json.JSONDecodeError):
+                    seed = json.loads(line).get("seed", seed)
+    if seed is not None:
+        logging.info(f"Resuming with the seed of {metrics_path}")
+    return seed
+
+
+def _get_job_cost(number_of_particles, temperature):
+    # Rough relative cost of a job: larger systems, lower temperatures and tighter
+    # stop conditions all need more steps
+    return number_of_particles / (temperature * _get_stop_condition(temperature))
 
 
 def _initialize_process(parent_pid):
@@ -157,24 +578,40 @@ def _initialize_process(parent_pid):
     signal.signal(signal.SIGINT, _handle_sigint)
 
 
-def multiple_temperature_runs(number_of_particles, temperatures, processes, path):
-    ground_state_expected_values = []
-    ground_state_stds = []
-    total_energy = []
-    total_energy_stds = []
+def multiple_model_runs(
+    jobs,
+    processes,
+    path,
+    engine="scalar",
+    convergence="batch_means",
+    resume=False,
+    track_levels=False,
+    track_heat_capacity=False,
+    profile=False,
+    seed=None,
+):
+    # Runs every (number of particles, temperature) job on one pool in the given
+    # order and yields each result as soon as it is done
     try:
         with multiprocessing.Pool(
             processes=processes, initializer=_initialize_process, initargs=[os.getpid()]
         ) as pool:
-            results = pool.starmap(
-                _run_model,
+            yield from pool.imap_unordered(
+                _run_job,
                 [
                     (
                         number_of_particles,
                         temperature,
-                        pathlib.Path(path).with_suffix(f".{temperature}.json"),
+                        path,
+                        engine,
+                        convergence,
+                        resume,
+                        track_levels,
+                        seed,
+                        track_heat_capacity,
+                        profile,
                     )
-                    for temperature in temperatures
+                    for number_of_particles, temperature in jobs
                 ],
             )
     except KeyboardInterrupt:
@@ -183,40 +620,413 @@ def multiple_temperature_runs(number_of_particles, temperatures, processes, path
         pool.join()
         raise
 
-    for result in results:
-        ground_state_expected_values.append(result.data.ground_level.expected_value)
-        ground_state_stds.append(result.data.ground_level.std)
-        total_energy_stds.append(result.data.total_energy_std)
-        total_energy.append(result.data.total_energy_expected_value)
-    return (
-        ground_state_expected_values,
-        ground_state_stds,
-        total_energy,
-        total_energy_stds,
+
+def _run_job(job):
+    *arguments, profile = job
+    number_of_particles, temperature, path, engine, convergence, _, _, seed, _ = arguments
+    start_time = time.monotonic()
+    if profile:
+        profiler = cProfile.Profile()
+        result, metrics, extra = profiler.runcall(_run_model, *arguments)
+        profiler.dump_stats(_get_profile_path(path, number_of_particles, temperature))
+    else:
+        result, metrics, extra = _run_model(*arguments)
+    record = metrics.to_record(
+        record="job",
+        number_of_particles=number_of_particles,
+        temperature=temperature,
+        engine=engine,
+        convergence=convergence,
+        pid=os.getpid(),
+        wall_time=time.monotonic() - start_time,
+        seed=seed,
+    )
+    return number_of_particles, temperature, result.data, extra, record
+
+
+def coordinate_queue(
+    path,
+    directory,
+    number_of_particles_to_temperatures,
+    number_of_particles_to_data,
+    engine="scalar",
+    convergence="batch_means",
+    track_levels=False,
+    track_heat_capacity=True,
+    seed=None,
+):
+    # Enqueues every job of the sweep into the shared directory, most expensive
+    # first, and waits for workers started with --worker on any host. Jobs whose
+    # worker stopped touching its claim are requeued, and results found in the
+    # directory are reused. Every result also goes to the local store.
+    queue = work_queue.WorkQueue(directory)
+    jobs = sorted(
+        [
+            (number_of_particles, temperature)
+            for number_of_particles, temperatures in number_of_particles_to_temperatures.items()
+            for temperature in temperatures
+        ],
+        key=lambda job: _get_job_cost(*job),
+        reverse=True,
+    )
+    names = {}
+    for rank, (number_of_particles, temperature) in enumerate(jobs):
+        job = {
+            "number_of_particles": number_of_particles,
+            "temperature": temperature,
+            "engine": engine,
+            "convergence": convergence,
+            "track_levels": track_levels,
+            "track_heat_capacity": track_heat_capacity,
+            "seed": seed,
+        }
+        name = _get_queue_job_name(job)
+        names[name] = (number_of_particles, temperature)
+        queue.enqueue(name, job, rank=rank)
+    logging.info(f"Enqueued {len(names)} jobs in {directory}")
+
+    collected = set()
+    status = None
+    while len(collected) < len(names):
+        for name, worker in queue.requeue_stale():
+            logging.warning(f"Requeued {name}, the claim of {worker} went stale")
+        for name in sorted(queue.get_done_names() & names.keys() - collected):
+            number_of_particles, temperature = names[name]
+            result = queue.get_result(name)
+            _add_values(
+                number_of_particles_to_data,
+                number_of_particles,
+                temperature,
+                result["values"],
+            )
+            with store.ResultStore(_get_store_path(path)) as result_store:
+                result_store.add(
+                    number_of_particles,
+                    temperature,
+                    result["record"]["engine"],
+                    result["values"],
+                    seed=result["record"]["seed"],
+                    extra=result["extra"],
+                )
+            instrumentation.write_records(_get_metrics_path(path), [result["record"]])
+            collected.add(name)
+        if queue.get_status() != status:
+            status = queue.get_status()
+            logging.info(f"Queue: {status}, collected {len(collected)} of {len(names)}")
+        if len(collected) < len(names):
+            time.sleep(constants.QUEUE_POLL_INTERVAL)
+    for number_of_particles in number_of_particles_to_data:
+        _finish_number_of_particles(number_of_particles_to_data, number_of_particles)
+    _write_data(path, number_of_particles_to_data)
+
+
+def _get_queue_job_name(job):
+    # Jobs are deduplicated and their results reused by name, so every parameter
+    # that changes the result is part of it
+    flags = [name for name in ["track_levels", "track_heat_capacity"] if job[name]]
+    return "_".join(
+        [
+            str(int(job["number_of_particles"])),
+            str(job["temperature"]),
+            job["engine"],
+            job["convergence"],
+            str(job["seed"]),
+            *flags,
+        ]
+    )
+
+
+def run_queue_workers(directory, processes=1):
+    # Several local worker processes behave like workers on several hosts
+    if processes == 1:
+        _run_queue_worker(directory)
+        return
+    with multiprocessing.Pool(
+        processes=processes, initializer=_initialize_process, initargs=[os.getpid()]
+    ) as pool:
+        pool.map(_run_queue_worker, [directory] * processes)
+
+
+def _run_queue_worker(directory):
+    # Claims jobs until the queue is drained. Checkpoints live in the shared
+    # directory under the job name, so a requeued job resumes where its previous
+    # worker stopped.
+    queue = work_queue.WorkQueue(directory)
+    worker = work_queue.get_worker_name()
+    while True:
+        claim = queue.claim(worker)
+        if claim is None:
+            if queue.is_drained():
+                return
+            # Claims of other workers may still go stale and be requeued
+            time.sleep(constants.QUEUE_POLL_INTERVAL)
+            continue
+        job = claim.job
+        logging.info(f"Worker {worker} claimed {claim.name}")
+        start_time = time.monotonic()
+        with queue.heartbeat(claim):
+            result, metrics, extra = _run_model(
+                job["number_of_particles"],
+                job["temperature"],
+                queue.directory / f"{claim.name}.json",
+                engine=job["engine"],
+                convergence=job["convergence"],
+                resume=True,
+                track_levels=job["track_levels"],
+                seed=job["seed"],
+                track_heat_capacity=job["track_heat_capacity"],
+                write_store=False,
+            )
+        queue.complete(
+            claim,
+            {
+                "values": {
+                    **_get_values(result.data),
+                    "heat_capacity": result.data.heat_capacity,
+                    "heat_capacity_error": extra.get("heat_capacity_error"),
+                },
+                "extra": extra,
+                "record": metrics.to_record(
+                    record="job",
+                    number_of_particles=job["number_of_particles"],
+                    temperature=job["temperature"],
+                    engine=job["engine"],
+                    convergence=job["convergence"],
+                    pid=os.getpid(),
+                    worker=worker,
+                    wall_time=time.monotonic() - start_time,
+                    seed=job["seed"],
+                ),
+            },
+        )
+
+
+def ensemble_temperature_runs(
+    number_of_particles, temperatures, path, replicas=1, seed=None
+):
+    current_ensemble = ensemble.Ensemble(
+        number_of_particles=number_of_particles,
+        temperatures=temperatures,
+        stop_conditions=[
+            _get_stop_condition(temperature) for temperature in temperatures
+        ],
+        replicas=replicas,
+        seed=seed,
+    )
+    results = current_ensemble.run()
+    for temperature, result in zip(temperatures, results):
+        _write_result(
+            number_of_particles,
+            temperature,
+            path,
+            result,
+            engine="ensemble",
+            seed=seed,
+        )
+
+    return results
+
+
+def tempering_temperature_runs(number_of_particles, temperatures, path, engine, seed=None):
+    current_tempering = tempering.ParallelTempering(
+        number_of_particles=number_of_particles,
+        temperatures=temperatures,
+        stop_conditions=[
+            _get_stop_condition(temperature) for temperature in temperatures
+        ],
+        engine=engine,
+        seed=seed,
     )
+    results = current_tempering.run()
+    swap_acceptance_rates = current_tempering.swap_acceptance_rates + [None]
+    logging.info(f"Swap acceptance rates: {swap_acceptance_rates[:-1]}")
+    for temperature, result, swap_acceptance_rate, stop_condition in zip(
+        temperatures, results, swap_acceptance_rates, current_tempering.stop_conditions
+    ):
+        extra = {"swap_acceptance_rate": swap_acceptance_rate}
+        if number_of_particles <= constants.EXACT_MAX_PARTICLES:
+            # Swaps that broke the stationary law of the chains would bias the
+            # means. The doubling test bounds the relative change of the mean by
+            # the stop condition, which stands in for the standard error.
+            extra.update(
+                _cross_check(
+                    number_of_particles,
+                    temperature,
+                    result.data,
+                    stop_condition * result.data.ground_level.expected_value,
+                )
+            )
+        _write_result(
+            number_of_particles,
+            temperature,
+            path,
+            result.data,
+            engine=f"tempering-{engine}",
+            seed=seed,
+            extra=extra,
+        )
 
+    return [result.data for result in results]
+
+
+def exact_temperature_runs(number_of_particles, temperatures, path):
+    # The stationary values of the chain, which the sampling engines converge to,
+    # so the rows can stand next to theirs. The canonical values belong to a
+    # different ensemble and are only kept for reference, up to the sizes whose
+    # O(N^2) recursion stays cheap.
+    canonical = None
+    if number_of_particles <= constants.EXACT_MAX_PARTICLES:
+        canonical = exact.get_observables(number_of_particles, temperatures)
+    values = [
+        exact.get_stationary_observables(number_of_particles, temperature)
+        for temperature in temperatures
+    ]
+    with store.ResultStore(_get_store_path(path)) as result_store:
+        for index, (temperature, temperature_values) in enumerate(
+            zip(temperatures, values)
+        ):
+            extra = {"heat_capacity": temperature_values["heat_capacity"]}
+            if canonical is not None:
+                extra.update(
+                    {
+                        f"canonical_{name}": float(canonical[name][index])
+                        for name in exact.OBSERVABLES
+                    }
+                )
+            result_store.add(
+                number_of_particles, temperature, "exact", temperature_values, extra=extra
+            )
+    return values
 
-def _run_model(number_of_particles, temperature, path):
+
+def _run_model(
+    number_of_particles,
+    temperature,
+    path,
+    engine="scalar",
+    convergence="batch_means",
+    resume=False,
+    track_levels=False,
+    seed=None,
+    track_heat_capacity=False,
+    write_store=True,
+):
     current_model = model.Model(
         number_of_particles=number_of_particles,
         temperature=temperature,
         stop_condition=_get_stop_condition(temperature),
+        engine=engine,
+        convergence=convergence,
+        checkpoint_path=_get_checkpoint_path(path, number_of_particles, temperature),
+        resume=resume,
+        track_levels=track_levels,
+        seed=seed,
+        track_heat_capacity=track_heat_capacity,
     )
     result = current_model.run()
-    with open(path.as_posix(), "wt") as file:
-        json.dump(
-            {
-                "number_of_particles": number_of_particles,
-                "temperature": temperature,
-                "ground_state_expected_value": result.data.ground_level.expected_value,
-                "ground_state_std": result.data.ground_level.std,
-                "total_energy_expected_value": result.data.total_energy_expected_value,
-                "total_energy_std": result.data.total_energy_std,
-            },
-            file,
-            indent=4,
+    extra = {}
+    if convergence == "batch_means":
+        extra = {
+            "ground_state_error": result.convergence.standard_error,
+            "integrated_autocorrelation_time": result.convergence.integrated_autocorrelation_time,
+        }
+    if track_heat_capacity:
+        extra["heat_capacity"] = result.data.heat_capacity
+        if convergence == "batch_means":
+            extra["heat_capacity_error"] = result.heat_capacity_convergence.standard_error
+    if number_of_particles <= constants.EXACT_MAX_PARTICLES:
+        extra.update(
+            _cross_check(
+                number_of_particles,
+                temperature,
+                result.data,
+                result.convergence.standard_error
+                if convergence == "batch_means"
+                else None,
+            )
+        )
+    if track_levels:
+        extra["occupancy_expected_values"] = result.data.levels.expected_values.tolist()
+        extra["occupancy_stds"] = result.data.levels.stds.tolist()
+        # Enough to reweight the run to other temperatures, see reweighting.py
+        extra["mu"] = result.data.mu
+        extra["steps"] = result.data.steps
+        if convergence == "batch_means":
+            extra["level_batch_means"] = result.level_convergence.batch_means.tolist()
+    if write_store:
+        _write_result(
+            number_of_particles,
+            temperature,
+            path,
+            result.data,
+            engine,
+            seed=seed,
+            extra=extra,
+        )
+    return result, current_model.metrics, extra
+
+
+def _cross_check(number_of_particles, temperature, data, standard_error):
+    # The chain converges to the exact stationary values of its independent
+    # particles, so a mean many standard errors away from them means the run
+    # stopped before it converged. The canonical values are kept for reference,
+    # they belong to a different ensemble and are not compared.
+    stationary = exact.get_stationary_observables(
+        number_of_particles, temperature, mu=data.mu
+    )
+    canonical = exact.get_observables(number_of_particles, [temperature])
+    deviation = None
+    if standard_error is not None and 0 < standard_error < float("inf"):
+        deviation = (
+            data.ground_level.expected_value
+            - stationary["ground_state_expected_value"]
+        ) / standard_error
+        if abs(deviation) > constants.CROSS_CHECK_MAX_DEVIATION:
+            logging.warning(
+                f"Ground state mean {data.ground_level.expected_value:.4g} is "
+                f"{deviation:.1f} standard errors from the exact stationary value "
+                f"{stationary['ground_state_expected_value']:.4g} "
+                f"(Temperature: {temperature}, number of particles: "
+                f"{number_of_particles})"
+            )
+    return {
+        "stationary_ground_state_expected_value": stationary[
+            "ground_state_expected_value"
+        ],
+        "stationary_total_energy_expected_value": stationary[
+            "total_energy_expected_value"
+        ],
+        "ground_state_deviation": deviation,
+        "canonical_ground_state_expected_value": float(
+            canonical["ground_state_expected_value"][0]
+        ),
+        "canonical_total_energy_expected_value": float(
+            canonical["total_energy_expected_value"][0]
+        ),
+    }
+
+
+def _write_result(
+    number_of_particles, temperature, path, data, engine, seed=None, extra=None
+):
+    with store.ResultStore(_get_store_path(path)) as result_store:
+        result_store.add(
+            number_of_particles,
+            temperature,
+            engine,
+            _get_values(data),
+            seed=seed,
+            extra=extra,
         )
-    return result
+
+
+def _get_values(data):
+    return {
+        "ground_state_expected_value": data.ground_level.expected_value,
+        "ground_state_std": data.ground_state_std,
+        "total_energy_expected_value": data.total_energy_expected_value,
+        "total_energy_std": data.total_energy_std,
+    }
 
 
 def _get_temperatures(number_of_particles, step_side=0.2):
@@ -227,6 +1037,21 @@ def _get_temperatures(number_of_particles, step_side=0.2):
     ]
 
 
+def _get_adaptive_temperatures(number_of_particles):
+    # A coarse grid over the same range as _get_temperatures, on multiples of
+    # ADAPTIVE_MIN_STEP so that refined temperatures line up with it
+    min_step = constants.ADAPTIVE_MIN_STEP
+    max_temperature = _get_max_temperature(number_of_particles)
+    step = min_step * max(
+        1,
+        round(max_temperature / constants.ADAPTIVE_INITIAL_INTERVALS / min_step),
+    )
+    return [
+        round(min_step + index * step, 10)
+        for index in range(int(np.ceil((max_temperature - min_step) / step)) + 1)
+    ]
+
+
 def _get_max_temperature(number_of_particles):
     if number_of_particles == 1e4:
         return 25
@@ -243,85 +1068,5 @@ def _get_stop_condition(temperature):
         return 1e-2
 
 
-def plot_ground_state_expected_value(
-    temperature_range,
-    ground_state_expected_values,
-    number_of_particles,
-    ground_state_stds,
-    add_errorbar=True,
-    ax=None,
-):
-    if ax is None:
-        ax = plt.gca()
-
-    x = temperature_range
-    y = [
-        expected_value / number_of_particles
-        for expected_value in ground_state_expected_values
-    ]
-    ax.plot(x, y, label=f"number of particles: {number_of_particles}")
-    if add_errorbar:
-        ax.errorbar(
-            x,
-            y,
-            yerr=[
-                std / expected_value
-                for expected_value, std in zip(
-                    ground_state_expected_values, ground_state_stds
-                )
-            ],
-            fmt="none",
-            ecolor="black",
-            elinewidth=0.5,
-            capsize=2,
-        )
-    ax.set_xlabel("Temperature")
-    ax.set_ylabel("Ground state expected value")
-    ax.set_title(f"Number of particles: {number_of_particles}")
-
-
-def plot_specific_heat_capacity(
-    number_of_particles,
-    temperatures,
-    total_energies,
-    critical_temperature=None,
-    ax=None,
-):
-    if ax is None:
-        ax = plt.gca()
-
-    heat_capacities = calculations.get_specific_heat_capacities(
-        total_energies=total_energies, temperatures=temperatures,
-    )
-    if critical_temperature is not None:
-        ax.axvline(x=critical_temperature, color="red", linestyle="--")
-
-    ax.plot(temperatures[:-1], heat_capacities, "bo")
-    ax.set_xlabel("Temperature")
-    ax.set_ylabel("Specific heat capacity")
-    ax.set_title(f"Number of particles: {number_of_particles}")
-
-def plot_critical_temperature(data):
-    critical_temperatures = []
-    for number_of_particles, number_of_particles_data in data.items():
-        critical_temperatures.append(
-            calculations.get_critical_temperature(
-                temperature_range=number_of_particles_data["temperatures"],
-                ground_state_expected_values=number_of_particles_data[
-                    "ground_state_expected_values"
-                ],
-                number_of_particles=int(number_of_particles),
-            )
-        )
-    print(critical_temperatures)
-    plt.plot([int(key) for key in data.keys()], critical_temperatures)
-    plt.xlabel("Number of particles")
-    plt.ylabel("Critical temperature")
-    plt.loglog()
-    plt.grid()
-    plt.title("Critical temperature (log-log scale)")
-    plt.show()
-
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,166 @@
+import json
+import pathlib
+import sqlite3
+import time
+
+import constants
+
+COLUMNS = [
+    "ground_state_expected_value",
+    "ground_state_std",
+    "total_energy_expected_value",
+    "total_energy_std",
+]
+PLOT_COLUMNS = {
+    "ground_state_expected_values": "ground_state_expected_value",
+    "ground_state_stds": "ground_state_std",
+    "total_energy_expected_values": "total_energy_expected_value",
+    "total_energy_stds": "total_energy_std",
+    "heat_capacities": "json_extract(extra, '$.heat_capacity')",
+    "heat_capacity_errors": "json_extract(extra, '$.heat_capacity_error')",
+}
+
+
+class ResultStore:
+    # Append-only SQLite store with one row per finished job, keyed by
+    # (number_of_particles, temperature, seed, engine). Every pool worker opens its
+    # own connection; WAL mode lets them append while others read, and a row is
+    # durable as soon as add returns. When a job is run again, the newest row wins.
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.connection = sqlite3.connect(
+            self.path.as_posix(), timeout=constants.STORE_TIMEOUT
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS results (
+                number_of_particles REAL NOT NULL,
+                temperature REAL NOT NULL,
+                seed INTEGER,
+                engine TEXT NOT NULL,
+                {", ".join(f"{column} REAL" for column in COLUMNS)},
+                extra TEXT,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute(
+            """
+            CREATE INDEX IF NOT EXISTS results_key
+            ON results (number_of_particles, temperature, seed, engine)
+            """
+        )
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, number_of_particles, temperature, engine, values, seed=None, extra=None):
+        with self.connection:
+            self.connection.execute(
+                f"""
+                INSERT INTO results (
+                    number_of_particles, temperature, seed, engine,
+                    {", ".join(COLUMNS)}, extra, created
+                ) VALUES ({", ".join("?" * (len(COLUMNS) + 6))})
+                """,
+                [
+                    float(number_of_particles),
+                    float(temperature),
+                    seed,
+                    engine,
+                    *[values[column] for column in COLUMNS],
+                    json.dumps(extra or {}),
+                    time.time(),
+                ],
+            )
+
+    def iter_results(self, number_of_particles, engine=None, seed=None):
+        # The newest row of every temperature sorted by temperature, with extra
+        yield from map(
+            _to_result,
+            self._select(
+                ["number_of_particles", "temperature", "seed", "engine", *COLUMNS, "extra"],
+                number_of_particles=number_of_particles,
+                engine=engine,
+                seed=seed,
+            ),
+        )
+
+    def get_numbers_of_particles(self):
+        return [
+            number_of_particles
+            for (number_of_particles,) in self.connection.execute(
+                "SELECT DISTINCT number_of_particles FROM results ORDER BY number_of_particles"
+            )
+        ]
+
+    def iter_column(self, column, number_of_particles, engine=None, seed=None):
+        # Yields (temperature, value) pairs sorted by temperature, reading only the
+        # requested column of the newest row of every temperature
+        yield from self._select(
+            ["temperature", column],
+            number_of_particles=number_of_particles,
+            engine=engine,
+            seed=seed,
+        )
+
+    def to_plot_data(self, engine=None, seed=None):
+        # The same layout as the aggregate JSON that plotting.plot_data reads
+        data = {}
+        for number_of_particles in self.get_numbers_of_particles():
+            number_of_particles_data = {}
+            for key, column in PLOT_COLUMNS.items():
+                temperatures, values = [], []
+                for temperature, value in self.iter_column(
+                    column, number_of_particles, engine=engine, seed=seed
+                ):
+                    temperatures.append(temperature)
+                    values.append(value)
+                number_of_particles_data["temperatures"] = temperatures
+                number_of_particles_data[key] = values
+            data[str(int(number_of_particles))] = number_of_particles_data
+        return data
+
+    def _select(
+        self, columns, number_of_particles, temperature=None, engine=None, seed=None
+    ):
+        conditions = ["number_of_particles = ?"]
+        parameters = [float(number_of_particles)]
+        for name, value in [
+            ("temperature", temperature),
+            ("engine", engine),
+            ("seed", seed),
+        ]:
+            if value is not None:
+                conditions.append(f"{name} = ?")
+                parameters.append(value)
+        where = " AND ".join(conditions)
+        return iter(
+            self.connection.execute(
+                f"""
+                SELECT {", ".join(columns)} FROM results
+                WHERE rowid IN (
+                    SELECT MAX(rowid) FROM results WHERE {where}
+                    GROUP BY temperature
+                )
+                ORDER BY temperature
+                """,
+                parameters,
+            )
+        )
+
+
+def _to_result(row):
+    result = dict(
+        zip(["number_of_particles", "temperature", "seed", "engine", *COLUMNS], row[:-1])
+    )
+    result.update(json.loads(row[-1]))
+    return result
@@ -0,0 +1,118 @@
+import logging
+
+import numpy as np
+
+import calculations
+import constants
+import model
+
+
+class ParallelTempering:
+    # Runs one model.Run per temperature and every swap_interval steps proposes to
+    # exchange the configurations of neighbouring temperatures. The accumulators
+    # stay with their temperature, only the particles move between chains. All
+    # chains share the half/full doubling test of model.Model.run and stop once
+    # every temperature meets its stop condition.
+    def __init__(
+        self,
+        number_of_particles,
+        temperatures,
+        stop_conditions,
+        engine="block",
+        swap_interval=constants.SWAP_INTERVAL,
+        seed=None,
+    ):
+        self.number_of_particles = number_of_particles
+        self.temperatures = list(temperatures)
+        self.stop_conditions = list(stop_conditions)
+        self.swap_interval = swap_interval
+        self.seed = seed
+        # The swap decisions get their own stream, next to the one of every chain
+        self.rng = np.random.default_rng(
+            np.random.SeedSequence(seed, spawn_key=(int(number_of_particles),))
+        )
+        self.models = [
+            model.Model(
+                number_of_particles=number_of_particles,
+                temperature=temperature,
+                stop_condition=stop_condition,
+                engine=engine,
+                seed=seed,
+            )
+            for temperature, stop_condition in zip(
+                self.temperatures, self.stop_conditions
+            )
+        ]
+        self.runs = [current_model._create_run() for current_model in self.models]
+        # The swaps have to keep the stationary law of every chain, which is not a
+        # Boltzmann weight, so they are accepted on the level probabilities
+        self.log_probabilities = [
+            calculations.get_stationary_log_probabilities(
+                run.data.mu, run.temperature, run.particles.max_energy_level
+            )
+            for run in self.runs
+        ]
+        self.swap_attempts = [0] * (len(self.runs) - 1)
+        self.swap_accepts = [0] * (len(self.runs) - 1)
+        self._swap_parity = 0
+
+    @property
+    def swap_acceptance_rates(self):
+        return [
+            accepts / attempts if attempts else None
+            for accepts, attempts in zip(self.swap_accepts, self.swap_attempts)
+        ]
+
+    def run(self):
+        steps = int(self.number_of_particles * 1e2 // 2)
+        while True:
+            steps *= 2
+            if steps > constants.MAX_STEPS:
+                logging.info(f"Max steps reached: {steps}")
+                break
+
+            logging.info(
+                f"Running {steps:.0e} steps on {len(self.runs)} temperatures "
+                f"(swap acceptance: {self.swap_acceptance_rates})"
+            )
+            self.run_steps(steps // 2)
+            half_expected_values = self._get_ground_state_expected_values()
+            self.run_steps(steps // 2)
+            full_expected_values = self._get_ground_state_expected_values()
+            if all(
+                abs(full - half) / full <= stop_condition
+                for half, full, stop_condition in zip(
+                    half_expected_values, full_expected_values, self.stop_conditions
+                )
+            ):
+                break
+
+        return self.runs
+
+    def run_steps(self, steps):
+        while steps > 0:
+            sweep_steps = min(steps, self.swap_interval)
+            for run in self.runs:
+                run.run_steps(sweep_steps)
+            self._propose_swaps()
+            steps -= sweep_steps
+
+    def _propose_swaps(self):
+        # Alternate between the (0, 1), (2, 3), ... and (1, 2), (3, 4), ... pairs so
+        # that every proposal in a round involves distinct chains
+        for index in range(self._swap_parity, len(self.runs) - 1, 2):
+            run_a, run_b = self.runs[index], self.runs[index + 1]
+            self.swap_attempts[index] += 1
+            swap_probability = calculations.get_swap_probability(
+                occurrences_a=run_a.particles.as_array(),
+                occurrences_b=run_b.particles.as_array(),
+                log_probabilities_a=self.log_probabilities[index],
+                log_probabilities_b=self.log_probabilities[index + 1],
+            )
+            if self.rng.random() < swap_probability:
+                run_a.swap_particles(run_b)
+                self.swap_accepts[index] += 1
+        self._swap_parity = 1 - self._swap_parity
+
+    def _get_ground_state_expected_values(self):
+        return [run.data.ground_level.expected_value for run in self.runs]
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+import model
+
+NUMBER_OF_LEVELS = 8
+NUMBER_OF_PARTICLES = 20
+
+
+def get_random_block(rng, steps, number_of_moves):
+    # Initial occupancies and a valid sequence of single level moves at distinct
+    # steps, together with the occupancies after every step
+    levels = rng.integers(0, NUMBER_OF_LEVELS, size=NUMBER_OF_PARTICLES)
+    occurrences = np.bincount(levels, minlength=NUMBER_OF_LEVELS)
+    move_steps = np.sort(rng.choice(steps, size=number_of_moves, replace=False))
+    from_levels, to_levels = [], []
+    trace = np.empty((steps, NUMBER_OF_LEVELS), dtype=np.int64)
+    current = occurrences.copy()
+    moves = dict.fromkeys(move_steps.tolist())
+    for step in range(steps):
+        if step in moves:
+            particle = rng.integers(NUMBER_OF_PARTICLES)
+            from_level = levels[particle]
+            if from_level == 0:
+                to_level = 1
+            elif from_level == NUMBER_OF_LEVELS - 1:
+                to_level = from_level - 1
+            else:
+                to_level = from_level + rng.choice([-1, 1])
+            levels[particle] = to_level
+            current[from_level] -= 1
+            current[to_level] += 1
+            from_levels.append(from_level)
+            to_levels.append(to_level)
+        trace[step] = current
+    return occurrences, move_steps, np.array(from_levels), np.array(to_levels), trace
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_level_statistics_match_per_step_trace(seed):
+    rng = np.random.default_rng(seed)
+    statistics = model.LevelStatistics(NUMBER_OF_LEVELS)
+    traces = []
+    for steps, number_of_moves in [(50, 0), (200, 37), (1000, 400), (1, 1)]:
+        occurrences, move_steps, from_levels, to_levels, trace = get_random_block(
+            rng, steps, number_of_moves
+        )
+        statistics.add_moves(occurrences, move_steps, from_levels, to_levels, steps)
+        traces.append(trace)
+    trace = np.concatenate(traces)
+
+    assert statistics.count == len(trace)
+    np.testing.assert_allclose(statistics.expected_values, trace.mean(axis=0))
+    np.testing.assert_allclose(
+        statistics.variances, trace.var(axis=0), rtol=1e-10, atol=1e-12
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_scores_match_per_step_trace(seed):
+    rng = np.random.default_rng(seed)
+    score_table = rng.normal(size=NUMBER_OF_LEVELS)
+    data = model.RunData(
+        temperature=1,
+        mu=0,
+        ground_level=model.EnergyLevel(level=0),
+        score_sum=0.0,
+        energy_score_sum=0.0,
+    )
+    score_sum = energy_score_sum = 0.0
+    for steps, number_of_moves in [(50, 0), (200, 37), (1000, 400)]:
+        occurrences, move_steps, from_levels, to_levels, trace = get_random_block(
+            rng, steps, number_of_moves
+        )
+        data.add_scores(
+            occurrences, move_steps, from_levels, to_levels, steps, score_table
+        )
+        energies = trace @ np.arange(NUMBER_OF_LEVELS)
+        scores = trace @ score_table
+        score_sum += scores.sum()
+        energy_score_sum += (energies * scores).sum()
+
+    assert data.score_sum == pytest.approx(score_sum)
+    assert data.energy_score_sum == pytest.approx(energy_score_sum)
+
+
+def test_energy_level_variance_matches_trace():
+    rng = np.random.default_rng(0)
+    trace = rng.integers(10 ** 7, 10 ** 7 + 3, size=10 ** 4)
+    energy_level = model.EnergyLevel(level=0)
+    energy_level.add_block(trace[:5000])
+    for occurrences in trace[5000:]:
+        energy_level.add(int(occurrences))
+
+    assert energy_level.expected_value == pytest.approx(trace.mean())
+    assert energy_level.variance == pytest.approx(trace.var())
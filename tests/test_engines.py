@@ -0,0 +1,68 @@
+import pytest
+
+import constants
+import ensemble
+import exact
+import model
+
+NUMBER_OF_PARTICLES = 10
+# Relative tolerance of the fluctuations, which carry no error estimate
+STD_TOLERANCE = 0.1
+
+
+# The stop conditions of run._get_stop_condition
+@pytest.mark.parametrize("temperature, stop_condition", [(0.6, 1e-3), (1.6, 5e-3)])
+@pytest.mark.parametrize("engine", list(model.ENGINES))
+def test_engine_matches_exact_stationary_values(engine, temperature, stop_condition):
+    current_model = model.Model(
+        number_of_particles=NUMBER_OF_PARTICLES,
+        temperature=temperature,
+        stop_condition=stop_condition,
+        engine=engine,
+        seed=2020,
+        track_heat_capacity=True,
+    )
+    result = current_model.run()
+    expected = exact.get_stationary_observables(
+        NUMBER_OF_PARTICLES, temperature, mu=result.data.mu
+    )
+
+    assert abs(
+        result.data.ground_level.expected_value
+        - expected["ground_state_expected_value"]
+    ) <= constants.CROSS_CHECK_MAX_DEVIATION * result.convergence.standard_error
+    assert abs(
+        result.data.heat_capacity - expected["heat_capacity"]
+    ) <= constants.CROSS_CHECK_MAX_DEVIATION * (
+        result.heat_capacity_convergence.standard_error
+    )
+    assert result.data.ground_state_std == pytest.approx(
+        expected["ground_state_std"], rel=STD_TOLERANCE
+    )
+    assert result.data.total_energy_expected_value == pytest.approx(
+        expected["total_energy_expected_value"], rel=STD_TOLERANCE
+    )
+    assert result.data.total_energy_std == pytest.approx(
+        expected["total_energy_std"], rel=STD_TOLERANCE
+    )
+
+
+def test_ensemble_matches_exact_stationary_values():
+    temperatures = [0.4, 1.0, 1.6]
+    current_ensemble = ensemble.Ensemble(
+        number_of_particles=NUMBER_OF_PARTICLES,
+        temperatures=temperatures,
+        stop_conditions=[1e-3] * len(temperatures),
+        replicas=4,
+        seed=2020,
+    )
+    for temperature, data in zip(temperatures, current_ensemble.run()):
+        expected = exact.get_stationary_observables(
+            NUMBER_OF_PARTICLES, temperature, mu=data.mu
+        )
+        for value, name in [
+            (data.ground_level.expected_value, "ground_state_expected_value"),
+            (data.ground_state_std, "ground_state_std"),
+            (data.total_energy_std, "total_energy_std"),
+        ]:
+            assert value == pytest.approx(expected[name], rel=STD_TOLERANCE)
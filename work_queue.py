@@ -0,0 +1,143 @@
+import contextlib
+import dataclasses
+import json
+import os
+import pathlib
+import socket
+import threading
+import time
+
+import constants
+
+
+@dataclasses.dataclass
+class Claim:
+    name: str
+    job: dict
+    path: pathlib.Path
+
+
+class WorkQueue:
+    # A sweep shared through a directory that every worker can reach, for example
+    # over NFS. Every job is a JSON file in pending/. A worker claims one by
+    # renaming it into claimed/ under its own name, which exactly one worker can
+    # win, and keeps touching the claimed file while it works. Results are written
+    # to results/ and the claim is removed. A claim whose file has not been touched
+    # for a while belongs to a worker that died, and is renamed back to pending/.
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.pending = self.directory / "pending"
+        self.claimed = self.directory / "claimed"
+        self.results = self.directory / "results"
+        for directory in [self.pending, self.claimed, self.results]:
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def enqueue(self, name, job, rank=0):
+        # Lower ranks are claimed first. Jobs that are already queued, claimed or
+        # done are left alone, so a sweep can be enqueued again after a restart.
+        if name in self.get_names():
+            return False
+        _write_json(self.pending / f"{rank:06d}_{name}.json", {"name": name, **job})
+        return True
+
+    def claim(self, worker):
+        for path in sorted(self.pending.glob("*.json")):
+            claimed_path = self.claimed / f"{path.stem}@{worker}.json"
+            try:
+                # Touched first, a rename keeps the modification time and a claim
+                # that looks stale could be requeued before it is touched
+                os.utime(path)
+                os.rename(path, claimed_path)
+                with claimed_path.open("rt") as file:
+                    job = json.load(file)
+            except FileNotFoundError:
+                # Another worker was faster, or the claim was requeued
+                continue
+            return Claim(name=job.pop("name"), job=job, path=claimed_path)
+        return None
+
+    @contextlib.contextmanager
+    def heartbeat(self, claim, interval=constants.QUEUE_HEARTBEAT_INTERVAL):
+        # Touches the claimed file from a background thread while the job runs
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(interval):
+                try:
+                    os.utime(claim.path)
+                except FileNotFoundError:
+                    # Requeued as stale, the result is still written when done
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def complete(self, claim, result):
+        _write_json(self.results / f"{claim.name}.json", result)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(claim.path)
+
+    def requeue_stale(self, timeout=constants.QUEUE_STALE_TIME):
+        requeued = []
+        now = time.time()
+        for path in self.claimed.glob("*.json"):
+            stem, _, worker = path.stem.rpartition("@")
+            try:
+                if now - path.stat().st_mtime < timeout:
+                    continue
+                if (self.results / f"{stem.partition('_')[2]}.json").exists():
+                    os.remove(path)
+                    continue
+                os.rename(path, self.pending / f"{stem}.json")
+            except FileNotFoundError:
+                # Completed or requeued in the meantime
+                continue
+            requeued.append((stem.partition("_")[2], worker))
+        return requeued
+
+    def get_names(self):
+        return {
+            *[path.stem.partition("_")[2] for path in self.pending.glob("*.json")],
+            *[
+                path.stem.rpartition("@")[0].partition("_")[2]
+                for path in self.claimed.glob("*.json")
+            ],
+            *self.get_done_names(),
+        }
+
+    def get_done_names(self):
+        return {path.stem for path in self.results.glob("*.json")}
+
+    def get_status(self):
+        return {
+            "pending": len(list(self.pending.glob("*.json"))),
+            "claimed": len(list(self.claimed.glob("*.json"))),
+            "done": len(self.get_done_names()),
+        }
+
+    def is_drained(self):
+        status = self.get_status()
+        return status["pending"] == 0 and status["claimed"] == 0
+
+    def get_result(self, name):
+        with (self.results / f"{name}.json").open("rt") as file:
+            return json.load(file)
+
+
+def get_worker_name():
+    # Unique across the hosts and processes that share the directory
+    host = socket.gethostname().replace("@", "_").replace("/", "_")
+    return f"{host}-{os.getpid()}"
+
+
+def _write_json(path, data):
+    # Written to a temporary file and renamed, so readers never see a partial file
+    temporary_path = path.with_name(f".{path.name}.tmp")
+    with temporary_path.open("wt") as file:
+        json.dump(data, file)
+    os.replace(temporary_path, path)